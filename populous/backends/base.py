@@ -3,6 +3,14 @@ import contextlib
 
 class Backend:
 
+    # does the backend prefer to receive the values to write by columns?
+    # (see `write_columns`)
+    columnar = False
+
+    # can the backend load the batches encoded by 'encode_rows' in loader
+    # processes? (see `populous.pipeline`)
+    loadable = False
+
     def __init__(self, *args, **kwargs):
         self.closed = False
 
@@ -18,6 +26,25 @@ class Backend:
     def write(self, item, objs):
         pass
 
+    def write_columns(self, item, columns, size):
+        # Write 'size' objects, given as a list of values for each field
+        # of 'item.db_fields'.
+        # Backends able to consume the columns directly should override
+        # this method.
+        if columns:
+            objs = tuple(zip(*columns))
+        else:
+            objs = ((),) * size
+        return self.write(item, objs)
+
+    def encode_rows(self, item, rows):
+        # Return the bytes to give to 'load' to write the rows (tuples of
+        # values of 'item.db_fields') in the table of the item.
+        raise NotImplementedError()
+
+    def load(self, table, fields, data):
+        raise NotImplementedError()
+
     def select_random(self, table, fields=None, where=None, max_rows=None):
         raise NotImplementedError()
 
@@ -1,3 +1,5 @@
+import io
+import json
 import os
 import random
 import contextlib
@@ -16,7 +18,63 @@ except ImportError:
                        "Postgresql backend")
 
 
+def _text_value(value):
+    # the text representation of a value (not None) read by Postgresql,
+    # like the values adapted by psycopg2 in the queries: the lists are
+    # arrays, and the dicts are hstores
+    if value is True:
+        return 't'
+    if value is False:
+        return 'f'
+    if isinstance(value, psycopg2.extras.Json):
+        return json.dumps(value.adapted)
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return '\\x' + bytes(value).hex()
+    if isinstance(value, (list, tuple)):
+        return '{{{}}}'.format(','.join(
+            _array_element(element) for element in value
+        ))
+    if isinstance(value, dict):
+        return ', '.join(
+            '{}=>{}'.format(
+                _quote(str(key)),
+                'NULL' if element is None else _quote(str(element))
+            )
+            for key, element in value.items()
+        )
+    return str(value)
+
+
+def _array_element(value):
+    if value is None:
+        return 'NULL'
+    if isinstance(value, (list, tuple)):
+        # a dimension of a multidimensional array
+        return _text_value(value)
+    return _quote(_text_value(value))
+
+
+def _quote(text):
+    # a double-quoted element of an array or of a hstore
+    return '"{}"'.format(text.replace('\\', '\\\\').replace('"', '\\"'))
+
+
+def _copy_value(value):
+    # the text representation of a value in the COPY format
+    if value is None:
+        return '\\N'
+    return _text_value(value).translate(COPY_ESCAPES)
+
+
+COPY_ESCAPES = str.maketrans({
+    '\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r',
+})
+
+
 class Postgres(Backend):
+
+    loadable = True
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
@@ -80,6 +138,22 @@ class Postgres(Backend):
 
             return tuple(e[0] for e in cursor.fetchall())
 
+    def encode_rows(self, item, rows):
+        return ''.join(
+            '\t'.join(map(_copy_value, row)) + '\n' for row in rows
+        ).encode()
+
+    def load(self, table, fields, data):
+        with self.cursor as cursor:
+            try:
+                cursor.copy_expert(
+                    "COPY {} ({}) FROM STDIN".format(table, ", ".join(fields)),
+                    io.BytesIO(data)
+                )
+            except psycopg2.DatabaseError as e:
+                raise BackendError("Error while loading '{}': {}"
+                                   .format(table, e))
+
     @lru_cache()
     def count(self, table, where=None):
         with self.cursor as cursor:
@@ -1,11 +1,16 @@
 import logging
 
 from collections import OrderedDict, defaultdict
+from datetime import datetime
 
 from populous.bloom import BloomFilter
+from populous.buffer import BATCH_SIZE
 from populous.buffer import Buffer
+from populous.compat import cached_property
 from populous.exceptions import ValidationError
+from populous.generators.base import seed_shared_generators
 from populous.item import Item, COUNT_KEYS, ITEM_KEYS
+from populous.vars import Context
 
 
 logger = logging.getLogger('populous')
@@ -13,15 +18,81 @@ logger = logging.getLogger('populous')
 
 class Blueprint:
 
-    def __init__(self, items=None, vars_=None, backend=None):
+    def __init__(self, items=None, vars_=None, backend=None, seed=None,
+                 random_access=False, now=None):
         self.items = OrderedDict(items or {})
         self.vars = vars_ or {}
         self.backend = backend
 
+        # the seed of the random generators, to generate the same values
+        # on each run (see `BaseGenerator.random`)
+        self.seed = seed
+        if seed is not None:
+            seed_shared_generators(seed)
+
+        # the present of the generation, from which the dates are drawn in
+        # the past or in the future (see `DateTime.get_range`): it is fixed
+        # once, and given to get the same dates on each run with a seed
+        self.now = now or datetime.now()
+
+        # in the random access mode, the values of each row only depend on
+        # the seed and on the index of the row, so that any range of rows
+        # can be generated independently (see `BaseGenerator.seed_row`)
+        if random_access and seed is None:
+            raise ValidationError("The random access mode needs a seed.")
+        self.random_access = random_access
+
+        # the partition of the unique values owned by this process, as
+        # (index, count), when several processes generate the same items.
+        # Only the values drawn by the generators are partitioned (see
+        # `UniquenessMixin.partitioned`): in the random access mode, these
+        # values depend on the number of processes.
+        self.partition = None
+
+        # the context used to evaluate the expressions, sharing our vars
+        self.context = Context(self.vars)
+
         # a dict containing {<table>: {<fields>: bloom filter}}
         # to store the existing values of unique fields
         self.seen = defaultdict(lambda: defaultdict(BloomFilter))
 
+    @property
+    def dynamic_vars(self):
+        # the variables whose value changes during the generation:
+        # the current object, the parent objects used in the counts,
+        # and the values stored with 'store_in'
+        names = {'this'}
+        for item in self.items.values():
+            names.add(item.name)
+            names.update(item.store_in_global)
+        return frozenset(names)
+
+    @cached_property
+    def dependents(self):
+        # the items having a "count by" on each item or one of its
+        # ancestors, generated when a batch of the item is written
+        dependents = {}
+        for name, item in self.items.items():
+            names = frozenset(item.ancestors) | {name}
+            dependents[name] = [
+                dependent for dependent in self.items.values()
+                if dependent.count.by in names
+            ]
+        return dependents
+
+    @cached_property
+    def referenced_attributes(self):
+        # the names of the attributes used by any expression of any item,
+        # the fields of the objects whose name is not in this set are
+        # never used
+        attributes = set()
+        for item in self.items.values():
+            for expression in item.expressions:
+                attributes |= expression.attributes
+            for field in item.fields.values():
+                attributes.update(getattr(field, 'unique_with', None) or ())
+        return frozenset(attributes)
+
     def add_var(self, name, value):
         self.vars[name] = value
 
@@ -115,18 +186,47 @@ class Blueprint:
 
             item.add_count(**count)
 
+        if description.get('batch_size') is not None:
+            item.set_batch_size(description['batch_size'])
+
+        # check that the fields can be ordered (no circular references)
+        # when loading the blueprint rather than when generating it
+        item.ordered_fields
+
         self.items[name] = item
+        # the dependents will be computed again with the new item
+        self.__dict__.pop('dependents', None)
+        self.__dict__.pop('referenced_attributes', None)
 
     def preprocess(self):
         for item in self.items.values():
             item.preprocess()
 
-    def generate(self):
+    def get_root_counts(self):
+        # the number of objects to generate for each item without a
+        # "count by" (the others are generated with their parent)
+        return {
+            name: item.count(name) for name, item in self.items.items()
+            if not item.count.by
+        }
+
+    def generate(self, batch_size=BATCH_SIZE, adaptive=False,
+                 max_memory=None, counts=None, pipeline=None):
+        # 'counts' gives the number of objects to generate for the items
+        # without a "count by" (see `get_root_counts`), when they are
+        # not drawn during the generation, or the range of their rows
         logger.info("Getting existing unique values...")
 
         self.preprocess()
 
-        buffer = Buffer(self)
+        for item in self.items.values():
+            constants = [name for name in item.constant_fields if name != 'id']
+            if constants:
+                logger.info("Item '{}': computing the constant fields once: "
+                            "{}".format(item.name, ', '.join(constants)))
+
+        buffer = Buffer(self, maxlen=batch_size, adaptive=adaptive,
+                        max_memory=max_memory, pipeline=pipeline)
 
         logger.info("Starting generation...")
 
@@ -136,9 +236,19 @@ class Blueprint:
                 # the others will be created on the fly
                 continue
 
-            item.generate(buffer, item.count())
+            if counts is not None:
+                count = counts.get(item.name, 0)
+            else:
+                count = item.count(item.name)
+
+            item.write_needed_items(buffer)
+            if isinstance(count, range):
+                item.generate(buffer, len(count), first_row=count.start)
+            else:
+                item.generate(buffer, count)
 
         # write everything left in the buffer
         buffer.flush()
+        buffer.report()
 
         logger.info("Generation done.")
@@ -1,24 +1,138 @@
+import logging
+import sys
+import time
 from collections import deque, OrderedDict
 
+logger = logging.getLogger('populous')
+
+# the default number of objects written at once
+BATCH_SIZE = 1000
+# the bounds of the batch sizes tuned by the buffer
+MIN_BATCH_SIZE = 10
+MAX_BATCH_SIZE = 100000
+# the time the writing of a tuned batch should take (in seconds)
+TARGET_DURATION = 0.5
+# the maximum size of the values of a tuned batch (in bytes)
+MAX_BATCH_MEMORY = 64 * 1024 * 1024
+
+
+def row_size(values):
+    # the approximate memory used by the values of an object
+    return sum(sys.getsizeof(value) for value in values)
+
 
 class Buffer:
+    """
+    Hold the generated objects until a full batch can be written.
+
+    Writing a batch generates the items depending on it (see
+    `Item.generate_dependencies`), which may write other batches.
+    Instead of recursing, the generation of the dependencies is scheduled
+    as an iterator on a stack, and the stack is run step by step: the
+    dependencies of the last written batch are generated first, so only
+    one partial batch per level of the hierarchy is alive at once.
+
+    If the backend is columnar, the values to write are also stored by
+    columns as the objects are added, and are given to the backend as one
+    list per field.
+
+    Each item is written by batches of 'maxlen' objects, unless it has its
+    own batch size. The batch size of the items with an 'auto' batch size
+    (or of all the items without a batch size, if 'adaptive' is set) is
+    tuned after each write, so that writing a batch takes about
+    TARGET_DURATION seconds. When the blueprint has a seed, the batch
+    sizes are not tuned: the values read from the stores depend on when
+    the batches are written, which must not depend on the time taken by
+    the writes.
 
-    def __init__(self, blueprint, maxlen=1000):
+    If 'max_memory' is given, the approximate memory used by the objects
+    of all the buffers is kept below this number of bytes, by writing
+    the largest buffers before they are full.
+
+    If a 'pipeline' is given, the batches of the items which can be
+    written apart (see `Item.offloadable`) are encoded and sent to the
+    loader processes, instead of being written by the backend (see
+    `populous.pipeline`).
+    """
+
+    def __init__(self, blueprint, maxlen=BATCH_SIZE, adaptive=False,
+                 max_memory=None, pipeline=None):
         self.blueprint = blueprint
         self.backend = blueprint.backend
+        self.pipeline = pipeline
         self.maxlen = maxlen
         self.buffers = OrderedDict(
-            (item.name, deque(maxlen=self.maxlen))
-            for item in self.blueprint.items.values()
+            (item.name, deque()) for item in self.blueprint.items.values()
         )
 
+        # the current batch size of each item, and the items whose batch
+        # size is tuned
+        self.sizes = {}
+        self.tuned = set()
+        for item in self.blueprint.items.values():
+            if isinstance(item.batch_size, int):
+                self.sizes[item.name] = item.batch_size
+                continue
+            self.sizes[item.name] = maxlen
+            if item.batch_size == 'auto' or adaptive:
+                self.tuned.add(item.name)
+        if self.tuned and blueprint.seed is not None:
+            logger.warning(
+                "The batch sizes are not tuned, to generate the same data "
+                "with the seed: the items use a batch size of {}."
+                .format(maxlen)
+            )
+            self.tuned.clear()
+        # the iterators generating the dependencies of the written batches
+        self.pending = []
+        self.running = False
+
+        # the approximate memory used by the objects of each buffer,
+        # estimated from the first object of each batch
+        self.max_memory = max_memory
+        self.memory = {name: 0 for name in self.buffers}
+        self.total_memory = 0
+        self.row_sizes = {}
+
+        self.columnar = self.backend is not None and self.backend.columnar
+        if self.columnar:
+            self.columns = {
+                item.name: self._new_columns(item)
+                for item in self.blueprint.items.values()
+            }
+
+    def _new_columns(self, item):
+        columns = tuple([] for _ in item.db_fields)
+        return columns, tuple(column.append for column in columns)
+
     def add(self, obj):
         item = self.blueprint.items[type(obj).__name__]
         buffer = self.buffers[item.name]
         buffer.append(obj)
+        if self.columnar:
+            item.append_columns(obj, self.columns[item.name][1])
 
-        if len(buffer) == self.maxlen:
+        if len(buffer) >= self.sizes[item.name]:
             self.write(item, buffer)
+        elif self.max_memory is not None:
+            self.account(item, obj, len(buffer))
+
+    def account(self, item, obj, length):
+        name = item.name
+        if length == 1:
+            self.row_sizes[name] = (
+                row_size(item.db_values(obj)) + sys.getsizeof(obj)
+            )
+        size = self.row_sizes[name]
+        self.memory[name] += size
+        self.total_memory += size
+
+        while self.total_memory > self.max_memory:
+            # write the largest buffer
+            name = max(self.memory, key=self.memory.get)
+            if not self.buffers[name]:
+                break
+            self.write(self.blueprint.items[name])
 
     def flush(self):
         while any(self.buffers.values()):
@@ -29,8 +143,88 @@ class Buffer:
         buffer = buffer or self.buffers[item.name]
         if not buffer:
             return
-        ids = self.backend.write(
-            item, tuple(item.db_values(obj) for obj in buffer)
-        )
-        item.batch_written(self, buffer, ids)
+        batch = tuple(buffer)
         buffer.clear()
+        self.total_memory -= self.memory[item.name]
+        self.memory[item.name] = 0
+
+        start = time.perf_counter()
+        if self.pipeline is not None and item.offloadable:
+            if self.columnar:
+                columns = self._take_columns(item, len(batch))
+                rows = (
+                    tuple(zip(*columns)) if columns else ((),) * len(batch)
+                )
+            else:
+                rows = tuple(item.db_values(obj) for obj in batch)
+            self.pipeline.load(item, self.backend.encode_rows(item, rows))
+            ids = (None,) * len(batch)
+            values = rows[0]
+        elif self.columnar:
+            columns = self._take_columns(item, len(batch))
+            ids = self.backend.write_columns(item, columns, len(batch))
+            values = tuple(column[0] for column in columns)
+        else:
+            rows = tuple(item.db_values(obj) for obj in batch)
+            ids = self.backend.write(item, rows)
+            values = rows[0]
+
+        if item.name in self.tuned and len(batch) >= self.sizes[item.name]:
+            self.tune(item, time.perf_counter() - start, row_size(values))
+        item.batch_written(self, batch, ids)
+        self.run()
+
+    def tune(self, item, duration, size):
+        # Change the batch size of the item so that the next batches take
+        # about TARGET_DURATION to be written, by a factor of 2 at most
+        # to absorb the variations of the backend.
+        # The values of a batch must fit in MAX_BATCH_MEMORY.
+        current = self.sizes[item.name]
+        if duration > 0:
+            factor = min(max(TARGET_DURATION / duration, 0.5), 2)
+        else:
+            factor = 2
+        batch_size = round(current * factor)
+        batch_size = min(batch_size, MAX_BATCH_MEMORY // max(size, 1))
+        self.sizes[item.name] = min(
+            max(batch_size, MIN_BATCH_SIZE), MAX_BATCH_SIZE
+        )
+
+    def report(self):
+        for name in self.sizes:
+            if name not in self.tuned:
+                continue
+            logger.info(f"Item '{name}': batch size tuned to "
+                        f"{self.sizes[name]}")
+
+    def _take_columns(self, item, size):
+        columns, _ = self.columns[item.name]
+        self.columns[item.name] = self._new_columns(item)
+
+        # the constant fields are not stored for each object
+        constants = item.constant_fields
+        return tuple(
+            [constants[name]] * size if name in constants else column
+            for name, column in zip(item.db_fields, columns)
+        )
+
+    def schedule(self, iterator):
+        self.pending.append(iterator)
+
+    def run(self):
+        if self.running:
+            # we are writing a batch while generating dependencies,
+            # the loop below will take care of the new iterators
+            return
+
+        self.running = True
+        pending = self.pending
+        try:
+            while pending:
+                index = len(pending) - 1
+                try:
+                    next(pending[index])
+                except StopIteration:
+                    del pending[index]
+        finally:
+            self.running = False
@@ -1,11 +1,20 @@
+import functools
 import importlib
 import logging
+import secrets
 
 import click
 import click_log
 
 from .loader import load_blueprint
 from .exceptions import ValidationError, YAMLError, BackendError
+from .compat import shared_memory
+from .coordinator import run_coordinator, run_node
+from .exceptions import GenerationError
+from .generators.base import derive_seed
+from .pipeline import Pipeline
+from .stores import SharedStore, Store, unlink_shared_store
+from .workers import COMMIT_MODES, PER_WORKER, Rollback, run_workers
 
 logger = logging.getLogger('populous')
 click_log.basic_config(logger)
@@ -33,32 +42,175 @@ def run():
     pass
 
 
-def _generic_run(modulename, classname, files, **kwargs):
+def _get_batch_size(batch_size):
+    if batch_size == 'auto':
+        return {'adaptive': True}
     try:
-        try:
-            module = importlib.import_module(
-                'populous.backends.' + modulename,
-                package='populous.backends'
+        batch_size = int(batch_size)
+        if batch_size <= 0:
+            raise ValueError()
+    except ValueError:
+        raise click.BadParameter(
+            "must be a positive integer or 'auto'",
+            param_hint="'--batch-size'"
+        )
+    return {'batch_size': batch_size}
+
+
+def _get_backend_cls(modulename, classname):
+    try:
+        module = importlib.import_module(
+            'populous.backends.' + modulename,
+            package='populous.backends'
+        )
+        return getattr(module, classname)
+    except (ImportError, AttributeError):
+        raise click.ClickException("Backend not found.")
+
+
+def _share_stores(blueprint, shared_stores, worker, workers):
+    # replace the stores shared between the workers
+    for name, prefix in shared_stores.items():
+        if type(blueprint.vars.get(name)) is not Store:
+            raise click.ClickException(
+                f"The store '{name}' cannot be shared: it is not a global "
+                "'store_in' var without a key."
             )
-            backend_cls = getattr(module, classname)
-        except (ImportError, AttributeError):
-            raise click.ClickException("Backend not found.")
+        blueprint.vars[name] = SharedStore(prefix, worker, workers)
+
+
+def _generate(backend_cls, backend_kwargs, files, generate_kwargs,
+              seed=None, random_access=False, shared_stores=None, loaders=0,
+              now=None, counts=None, ready=None, worker=None, workers=None,
+              partition=None):
+    if seed is not None and worker is not None and not random_access:
+        # each worker generates different values (in the random access
+        # mode, the values of each row only depend on its index)
+        seed = derive_seed(seed, 'worker', worker)
+
+    backend = backend_cls(**backend_kwargs)
+    blueprint = get_blueprint(files, backend=backend, seed=seed,
+                              random_access=random_access, now=now)
+    if worker is not None:
+        # each worker generates its own unique values, unless given the
+        # partition of its node (see `run_node`)
+        blueprint.partition = partition or (worker, workers)
+        _share_stores(blueprint, shared_stores or {}, worker, workers)
 
-        backend = backend_cls(**kwargs)
-        blueprint = get_blueprint(files, backend=backend)
+    pipeline = None
+    try:
+        with backend.transaction():
+            if loaders:
+                pipeline = Pipeline(backend_cls, backend_kwargs, loaders)
+            blueprint.generate(counts=counts, pipeline=pipeline,
+                               **generate_kwargs)
+
+            if ready is not None and not ready():
+                raise Rollback()
+
+            if pipeline is not None:
+                logger.info("Waiting for the loaders...")
+                pipeline.close()
+
+            logger.info("Closing DB transaction...")
 
-        try:
-            with backend.transaction():
-                blueprint.generate()
+        # the values of the shared stores (usually ids) are only shared
+        # once committed, so that the other workers only reference rows
+        # visible to them
+        for name in shared_stores or ():
+            blueprint.vars[name].publish()
 
-                logger.info("Closing DB transaction...")
+    except BaseException:
+        if pipeline is not None:
+            # roll back the loaders, keeping the first error
+            try:
+                pipeline.close(commit=False)
+            except GenerationError as e:
+                logger.error(str(e))
+        raise
 
-        finally:
-            backend.close()
+    finally:
+        backend.close()
+        for name in shared_stores or ():
+            blueprint.vars[name].close()
+
+
+def _generic_run(modulename, classname, files, batch_size='1000',
+                 max_buffer_memory=None, workers=1, commit=PER_WORKER,
+                 seed=None, random_access=False, share_stores=(), loaders=0,
+                 now=None, join=None, **kwargs):
+    try:
+        if join and (workers > 1 or seed is not None or random_access or
+                     share_stores or now):
+            raise click.BadParameter(
+                "cannot be used with '--workers', '--seed', "
+                "'--random-access', '--share-store' nor '--now': the seed, "
+                "the random access mode and the present are given by the "
+                "coordinator",
+                param_hint="'--join'"
+            )
+        if random_access and seed is None:
+            raise click.BadParameter(
+                "needs a seed ('--seed')", param_hint="'--random-access'"
+            )
+        if share_stores and workers < 2:
+            raise click.BadParameter(
+                "needs several workers ('--workers')",
+                param_hint="'--share-store'"
+            )
+        if share_stores and shared_memory is None:
+            raise click.BadParameter(
+                "needs python>=3.8", param_hint="'--share-store'"
+            )
+        generate_kwargs = _get_batch_size(batch_size)
+        if max_buffer_memory:
+            generate_kwargs['max_memory'] = max_buffer_memory * 1024 * 1024
+
+        backend_cls = _get_backend_cls(modulename, classname)
+        if loaders and not backend_cls.loadable:
+            raise click.BadParameter(
+                "the backend cannot load the objects in other processes",
+                param_hint="'--loaders'"
+            )
+
+        if join:
+            # generate the units given by a coordinator
+            units = run_node(join, functools.partial(
+                _generate, backend_cls, kwargs, files, generate_kwargs,
+                loaders=loaders
+            ))
+            logger.info(f"{units} units generated.")
+        elif workers > 1:
+            # draw the number of objects of each root item once, and
+            # share them between the workers, with the same present
+            blueprint = get_blueprint(
+                files, seed=seed, random_access=random_access, now=now
+            )
+            counts = blueprint.get_root_counts()
+            # the prefix of the names of the shared memory segments of
+            # each shared store
+            token = secrets.token_hex(4)
+            shared_stores = {
+                name: f'populous_{token}_{index}'
+                for index, name in enumerate(share_stores)
+            }
+            try:
+                run_workers(
+                    _generate,
+                    (backend_cls, kwargs, files, generate_kwargs, seed,
+                     random_access, shared_stores, loaders, blueprint.now),
+                    counts, workers, commit=commit
+                )
+            finally:
+                for prefix in shared_stores.values():
+                    unlink_shared_store(prefix, workers)
+        else:
+            _generate(backend_cls, kwargs, files, generate_kwargs, seed,
+                      random_access, loaders=loaders, now=now)
 
         logger.info("Have fun!")
 
-    except BackendError as e:
+    except (BackendError, GenerationError) as e:
         raise click.ClickException(str(e))
 
 
@@ -68,10 +220,105 @@ def _generic_run(modulename, classname, files, **kwargs):
 @click.option('--db', help="Database name")
 @click.option('--user', help="Postgresql user name used to authenticate")
 @click.option('--password', help="Postgresql password used to authenticate")
+@click.option('--batch-size', default='1000', show_default=True,
+              help="Number of objects written at once, or 'auto' to tune "
+                   "it for each item")
+@click.option('--max-buffer-memory', type=click.IntRange(min=1),
+              help="Approximate memory (in MB) used by the objects waiting "
+                   "to be written, above which they are written early")
+@click.option('--workers', type=click.IntRange(min=1), default=1,
+              show_default=True,
+              help="Number of processes sharing the generation")
+@click.option('--commit', type=click.Choice(COMMIT_MODES),
+              default=PER_WORKER, show_default=True,
+              help="Commit the transaction of each worker when it is done, "
+                   "or all of them once all the workers are done")
+@click.option('--seed', help="Seed of the random generators, to generate "
+                             "the same data on each run")
+@click.option('--random-access', is_flag=True,
+              help="Generate the values of each row from the seed and the "
+                   "index of the row only, so that any range of rows gives "
+                   "the same values, whatever the number of workers "
+                   "(except the unique values shared between the workers)")
+@click.option('--now', type=click.DateTime(), metavar='DATETIME',
+              help="Present of the generation, from which the dates are "
+                   "drawn in the past or in the future (by default, the "
+                   "current time), to get the same dates on each run with "
+                   "a seed")
+@click.option('--share-store', 'share_stores', multiple=True,
+              metavar='NAME',
+              help="Share the integers (like ids) of a global 'store_in' "
+                   "var between the workers, in shared memory, once the "
+                   "transaction of their worker is committed")
+@click.option('--loaders', type=click.IntRange(min=0), default=0,
+              help="Number of processes loading the objects whose ids are "
+                   "not used, for each generating process")
+@click.option('--join', type=click.Path(file_okay=False), metavar='DIRECTORY',
+              help="Generate the units shared by a coordinator in this "
+                   "directory (see 'populous coordinate')")
 @click.argument('files', nargs=-1, required=True)
-def postgres(host, port, db, user, password, files):
-    return _generic_run('postgres', 'Postgres', files, host=host, port=port,
-                        db=db, user=user, password=password)
+def postgres(host, port, db, user, password, batch_size, max_buffer_memory,
+             workers, commit, seed, random_access, now, share_stores, loaders,
+             join, files):
+    return _generic_run('postgres', 'Postgres', files, batch_size=batch_size,
+                        max_buffer_memory=max_buffer_memory, workers=workers,
+                        commit=commit, seed=seed, random_access=random_access,
+                        share_stores=share_stores, loaders=loaders,
+                        now=now, join=join,
+                        host=host, port=port, db=db, user=user,
+                        password=password)
+
+
+@cli.command()
+@click.option('--units', type=click.IntRange(min=1), default=100,
+              show_default=True,
+              help="Number of work units sharing the objects of the root "
+                   "items")
+@click.option('--seed', help="Seed of the random generators, to generate "
+                             "the same data on each run")
+@click.option('--random-access', is_flag=True,
+              help="Generate the values of each row from the seed and the "
+                   "index of the row only, so that the units are the same "
+                   "whichever node generates them")
+@click.option('--now', type=click.DateTime(), metavar='DATETIME',
+              help="Present of the generation, from which the dates are "
+                   "drawn in the past or in the future (by default, the "
+                   "current time of the coordinator)")
+@click.option('--nodes', type=click.IntRange(min=1),
+              help="Number of nodes generating units at the same time, "
+                   "between which the unique values are shared (by "
+                   "default, they are shared between the units)")
+@click.option('--retries', type=click.IntRange(min=0), default=2,
+              show_default=True,
+              help="Number of times a unit which failed is given again to "
+                   "the nodes")
+@click.option('--timeout', type=click.IntRange(min=1), default=60,
+              show_default=True,
+              help="Seconds without news from a node after which its unit "
+                   "is given to another node")
+@click.argument('directory', type=click.Path(file_okay=False))
+@click.argument('files', nargs=-1, required=True)
+def coordinate(units, seed, random_access, now, nodes, retries, timeout,
+               directory, files):
+    """
+    Share a generation between the nodes started with '--join DIRECTORY',
+    the directory being shared by all the nodes.
+    """
+    if random_access and seed is None:
+        raise click.BadParameter(
+            "needs a seed ('--seed')", param_hint="'--random-access'"
+        )
+    blueprint = get_blueprint(
+        files, seed=seed, random_access=random_access, now=now
+    )
+    counts = blueprint.get_root_counts()
+    try:
+        run_coordinator(directory, counts, units, slots=nodes, seed=seed,
+                        random_access=random_access, now=blueprint.now,
+                        retries=retries, timeout=timeout)
+    except GenerationError as e:
+        raise click.ClickException(str(e))
+    logger.info("Have fun!")
 
 
 @cli.command()
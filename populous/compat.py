@@ -3,6 +3,22 @@ try:
 except ImportError:
     from cached_property import cached_property
 
+try:
+    import numpy
+except ImportError:
+    # numpy is optional, it is only used to generate values faster
+    numpy = None
+
+try:
+    from multiprocessing import resource_tracker
+    from multiprocessing import shared_memory
+except ImportError:
+    # python < 3.8, the stores cannot be shared between the workers
+    resource_tracker = shared_memory = None
+
 __all__ = [
     'cached_property',
+    'numpy',
+    'resource_tracker',
+    'shared_memory',
 ]
@@ -0,0 +1,413 @@
+"""
+Generation on several nodes.
+
+A coordinator shares the objects of the root items in work units, which
+are generated by nodes (on any number of machines) through a directory
+shared by all of them, like an NFS mount:
+
+    plan.json      the number of units and of slots, the seed, the random
+                   access mode and the present of the generation
+    slots/         the slots of the nodes generating a unit
+    heartbeats/    the heartbeats of the nodes, for each unit
+    pending/       the units waiting for a node
+    running/       the units being generated
+    committing/    the units whose transaction is being committed
+    done/          the units committed
+    failed/        the units which failed, their errors being in 'errors/'
+    stop           written by the coordinator once it is done
+
+Each unit is a file, moved from a state to the next one by renaming it, so
+that a unit is only claimed by one node. A node rewrites the heartbeat of
+its unit, a counter, while generating it: the units whose heartbeat did
+not change for a while on the clock of the coordinator (their node died)
+are given to another node, whatever the clocks of the nodes, and the units
+which failed are retried, up to 'retries' times. Their transaction is
+rolled back, so a unit is only committed once.
+
+Each unit is generated like the share of a worker (see `populous.workers`),
+its index being the index of the worker, so that in the random access mode
+its rows are the same whichever node generates it. Its unique values are in
+the partition of the slot claimed by its node for generating it: the
+number of slots limits the number of nodes generating units at the same
+time, and the units generated before with the same slot are committed, so
+that their unique values are read from the database.
+"""
+import json
+import logging
+import os
+import re
+import socket
+import threading
+import time
+from datetime import datetime
+
+from populous.exceptions import GenerationError
+from populous.workers import Rollback
+from populous.workers import split_counts
+
+logger = logging.getLogger('populous')
+
+PENDING = 'pending'
+RUNNING = 'running'
+COMMITTING = 'committing'
+DONE = 'done'
+FAILED = 'failed'
+STATES = (PENDING, RUNNING, COMMITTING, DONE, FAILED)
+
+UNIT_REGEX = re.compile(r'^(\d+)\.json$')
+
+
+class WorkDirectory:
+    """
+    The units of a generation, in a directory shared by the coordinator
+    and the nodes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _path(self, *parts):
+        return os.path.join(self.path, *parts)
+
+    def _write(self, path, data):
+        # write the file atomically, with a temporary name unique to this
+        # process on this host
+        tmp = os.path.join(
+            os.path.dirname(path),
+            '.{}.{}.{}'.format(os.path.basename(path), socket.gethostname(),
+                               os.getpid())
+        )
+        with open(tmp, 'w') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def create(self, counts, units, slots=None, seed=None,
+               random_access=False, now=None, heartbeat=1):
+        if os.path.exists(self._path('plan.json')):
+            raise GenerationError(
+                f"The directory '{self.path}' is already used by a "
+                "generation."
+            )
+        for state in STATES + ('errors', 'slots', 'heartbeats'):
+            os.makedirs(self._path(state), exist_ok=True)
+
+        for index, share in enumerate(split_counts(counts, units)):
+            self.write_unit(PENDING, {
+                'index': index,
+                'counts': {
+                    name: [rows.start, rows.stop]
+                    for name, rows in share.items()
+                },
+                'attempts': 0,
+            })
+
+        # the plan is written last: the nodes wait for it
+        self._write(self._path('plan.json'), json.dumps({
+            'units': units,
+            'slots': min(slots or units, units),
+            'seed': seed,
+            'random_access': random_access,
+            'now': now.isoformat() if now is not None else None,
+            'heartbeat': heartbeat,
+        }))
+
+    def read_plan(self):
+        try:
+            with open(self._path('plan.json')) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def stop(self):
+        self._write(self._path('stop'), '')
+
+    @property
+    def stopped(self):
+        return os.path.exists(self._path('stop'))
+
+    def units(self, state):
+        indexes = []
+        for name in os.listdir(self._path(state)):
+            match = UNIT_REGEX.match(name)
+            if match:
+                indexes.append(int(match.group(1)))
+        return sorted(indexes)
+
+    def unit_path(self, state, index):
+        return self._path(state, f'{index}.json')
+
+    def read_unit(self, state, index):
+        with open(self.unit_path(state, index)) as f:
+            return json.load(f)
+
+    def write_unit(self, state, unit):
+        self._write(self.unit_path(state, unit['index']), json.dumps(unit))
+
+    def move(self, index, source, target):
+        # move a unit, returning False when it is not in 'source' anymore
+        # (it was moved by another process)
+        try:
+            os.rename(self.unit_path(source, index),
+                      self.unit_path(target, index))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def heartbeat_path(self, index):
+        return self._path('heartbeats', str(index))
+
+    def beat(self, unit, count):
+        # rewrite the heartbeat of the attempt of a unit by this process
+        self._write(self.heartbeat_path(unit['index']), '{}.{}.{}.{}'.format(
+            unit['attempts'], socket.gethostname(), os.getpid(), count
+        ))
+
+    def read_heartbeat(self, index):
+        try:
+            with open(self.heartbeat_path(index)) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def claim(self):
+        # claim the first pending unit, or return None if there is none
+        for index in self.units(PENDING):
+            if self.move(index, PENDING, RUNNING):
+                return self.read_unit(RUNNING, index)
+        return None
+
+    def slot_path(self, slot):
+        return self._path('slots', str(slot))
+
+    def claim_slot(self, slots):
+        # claim the first free slot, or return None if there is none
+        for slot in range(slots):
+            try:
+                os.close(os.open(self.slot_path(slot),
+                                 os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            except FileExistsError:
+                continue
+            return slot
+        return None
+
+    def hold_slot(self, slot, unit):
+        # write the attempt of the unit generated with the slot
+        self._write(self.slot_path(slot), _attempt(unit))
+
+    def release_slot(self, slot, unit=None):
+        # release a slot, only if still held for the attempt of 'unit'
+        # when given (the slot of a node which stopped is released by the
+        # coordinator, and may be held by another node since)
+        try:
+            if unit is not None:
+                with open(self.slot_path(slot)) as f:
+                    if f.read() != _attempt(unit):
+                        return
+            os.unlink(self.slot_path(slot))
+        except FileNotFoundError:
+            pass
+
+    def release_slots(self, unit):
+        # release the slot of a unit whose node stopped
+        for name in os.listdir(self._path('slots')):
+            if name.isdigit():
+                self.release_slot(name, unit)
+
+    def error_path(self, index, attempt):
+        return self._path('errors', f'{index}.{attempt}.txt')
+
+    def write_error(self, index, attempt, error):
+        self._write(self.error_path(index, attempt), error)
+
+    def read_error(self, index, attempt):
+        try:
+            with open(self.error_path(index, attempt)) as f:
+                return f.read()
+        except FileNotFoundError:
+            return "Unknown error"
+
+
+def _attempt(unit):
+    return '{}.{}'.format(unit['index'], unit['attempts'])
+
+
+def run_coordinator(directory, counts, units, slots=None, seed=None,
+                    random_access=False, now=None, retries=2, timeout=60,
+                    poll=1):
+    """
+    Share 'counts' in 'units' work units in 'directory', and wait for the
+    nodes (see `run_node`) to generate them, up to 'slots' at the same
+    time (by default, as many as the units).
+
+    The units which failed are given again to the nodes up to 'retries'
+    times, as well as those whose heartbeat did not change for 'timeout'
+    seconds.
+    """
+    work = WorkDirectory(directory)
+    work.create(counts, units, slots=slots, seed=seed,
+                random_access=random_access, now=now,
+                heartbeat=timeout / 4)
+    logger.info(f"Waiting for the nodes to generate {units} units...")
+
+    errors = {}
+    # the last heartbeat of the units being generated, and when it changed
+    heartbeats = {}
+    done = 0
+    try:
+        while len(work.units(DONE)) + len(errors) < units:
+            _check_abandoned(work, timeout, heartbeats, errors)
+            for index in work.units(FAILED):
+                if index not in errors:
+                    _retry(work, index, retries, errors)
+
+            if len(work.units(DONE)) != done:
+                done = len(work.units(DONE))
+                logger.info(f"{done}/{units} units done.")
+            time.sleep(poll)
+    finally:
+        # let the nodes exit
+        work.stop()
+
+    if errors:
+        raise GenerationError('\n'.join(
+            f"Unit {index}: {error}"
+            for index, error in sorted(errors.items())
+        ))
+
+
+def _check_abandoned(work, timeout, heartbeats, errors):
+    # The heartbeats are compared with the previous ones, and their age
+    # measured with the clock of the coordinator only.
+    now = time.monotonic()
+    generating = set()
+    for state in (RUNNING, COMMITTING):
+        for index in work.units(state):
+            generating.add(index)
+            heartbeat = work.read_heartbeat(index)
+            if index not in heartbeats or heartbeats[index][0] != heartbeat:
+                heartbeats[index] = (heartbeat, now)
+            if now - heartbeats[index][1] < timeout:
+                continue
+
+            # the node stopped: once the unit is moved, the node cannot
+            # commit it anymore
+            if not work.move(index, state, FAILED):
+                continue
+            unit = work.read_unit(FAILED, index)
+            work.release_slots(unit)
+            if state == COMMITTING:
+                # the transaction may have been committed or not
+                errors[index] = (
+                    "The node stopped while committing: the objects of the "
+                    "unit may have been written."
+                )
+            else:
+                work.write_error(
+                    index, unit['attempts'],
+                    f"No news from the node for {timeout} seconds."
+                )
+
+    # forget the units not generated anymore
+    for index in set(heartbeats) - generating:
+        del heartbeats[index]
+
+
+def _retry(work, index, retries, errors):
+    unit = work.read_unit(FAILED, index)
+    error = work.read_error(index, unit['attempts'])
+    if unit['attempts'] >= retries:
+        errors[index] = error
+        return
+
+    logger.warning(f"Unit {index}: {error} Retrying...")
+    # removed before being pending again, as it may fail again at once
+    os.unlink(work.unit_path(FAILED, index))
+    unit['attempts'] += 1
+    work.write_unit(PENDING, unit)
+
+
+def run_node(directory, target, poll=1):
+    """
+    Generate the units of 'directory' (see `run_coordinator`) until the
+    coordinator is done, with 'target(counts=..., ready=..., worker=...,
+    workers=..., partition=..., seed=..., random_access=..., now=...)',
+    the partition of the unique values being the slot of the node.
+
+    Like with `run_workers`, the target must call 'ready()' before
+    committing its transaction, and roll it back if it returns False.
+    Return the number of units generated.
+    """
+    work = WorkDirectory(directory)
+    plan = work.read_plan()
+    while plan is None:
+        # the coordinator is not started yet
+        time.sleep(poll)
+        plan = work.read_plan()
+
+    generated = 0
+    while True:
+        slot = work.claim_slot(plan['slots'])
+        unit = work.claim() if slot is not None else None
+        if unit is not None:
+            work.hold_slot(slot, unit)
+            try:
+                generated += _run_unit(work, plan, unit, slot, target)
+            finally:
+                work.release_slot(slot, unit)
+            continue
+
+        if slot is not None:
+            work.release_slot(slot)
+        if work.stopped:
+            return generated
+        time.sleep(poll)
+
+
+def _run_unit(work, plan, unit, slot, target):
+    index = unit['index']
+    state = RUNNING
+    stopped = threading.Event()
+
+    def heartbeat():
+        count = 0
+        while not stopped.wait(plan['heartbeat']):
+            count += 1
+            work.beat(unit, count)
+
+    def ready():
+        nonlocal state
+        if not work.move(index, RUNNING, COMMITTING):
+            # the coordinator gave the unit to another node
+            return False
+        state = COMMITTING
+        return True
+
+    work.beat(unit, 0)
+    thread = threading.Thread(target=heartbeat, daemon=True)
+    thread.start()
+    logger.info(f"Generating the unit {index}...")
+    try:
+        target(
+            counts={
+                name: range(*rows) for name, rows in unit['counts'].items()
+            },
+            ready=ready, worker=index, workers=plan['units'],
+            partition=(slot, plan['slots']), seed=plan['seed'],
+            random_access=plan['random_access'],
+            now=plan['now'] and datetime.fromisoformat(plan['now']),
+        )
+    except Rollback:
+        logger.warning(f"Unit {index}: Given to another node, rolled back.")
+        return 0
+    except Exception as e:
+        error = str(e) or type(e).__name__
+        logger.error(f"Unit {index}: {error}")
+        work.write_error(index, unit['attempts'], error)
+        work.move(index, state, FAILED)
+        return 0
+    finally:
+        stopped.set()
+        thread.join()
+
+    work.move(index, state, DONE)
+    return 1
@@ -1,41 +1,209 @@
+from functools import partial
+
+
+class BaseObject:
+    """
+    The objects generated for an item, available as 'this' in the
+    expressions while they are generated.
+
+    Each item has its own subclass (see `Item.object_class`), with a slot
+    for each field: the id is set in place once the object is written.
+
+    The fields already generated are plain attributes. Accessing a field
+    not generated yet generates it: this happens when the order of the
+    fields could not be determined (see `Item.ordered_fields`), and for
+    the shadow fields, which are only generated when they are used (see
+    `Item.on_demand_fields`).
+    """
+    __slots__ = ('_factory', '_row')
+
+    def __init__(self, **values):
+        self._factory = None
+        for name, value in values.items():
+            setattr(self, name, value)
+
+    def __getattr__(self, name):
+        if name == '_factory':
+            raise AttributeError(name)
+        factory = self._factory
+        if factory is None or name not in factory.getters:
+            raise AttributeError(
+                "'{}' object has no attribute '{}'"
+                .format(type(self).__name__, name)
+            )
+        context = factory.blueprint.context
+        previous, context.this = context.this, self
+        value = factory.getters[name]()
+        context.this = previous
+
+        setattr(self, name, value)
+        return value
+
+    def __repr__(self):
+        # don't generate the missing fields
+        cls = type(self)
+        values = []
+        for name in cls.__slots__:
+            try:
+                value = getattr(cls, name).__get__(self, cls)
+            except AttributeError:
+                continue
+            values.append(f'{name}={value!r}')
+        return '{}({})'.format(cls.__name__, ', '.join(values))
+
+
+new = object.__new__
+
+
+def compile_builder(item):
+    """
+    Compile the function building the objects of an item.
+
+    The function sets the fields of 'this' in the order of their
+    dependencies. The value of the constant fields is inlined:
+
+        def build(this, getters, parent):
+            (g0, g1) = getters
+            this.parent = parent
+            this.id = g0()
+            this.kind = c1
+            this.name = g1()
+    """
+    ordered, lazy = item.ordered_fields
+    constants = item.constant_fields
+    on_demand = item.on_demand_fields
+    getters = {name: f'g{i}' for i, name in enumerate(item.generated_fields)}
+
+    lines = ['def build(this, getters, parent):']
+    lines.append('    ({}) = getters'.format(
+        ''.join(f'{getter}, ' for getter in getters.values())
+    ))
+
+    by = item.count.by
+    if by:
+        lines.append(f'    this.{by} = parent')
+
+    namespace = {}
+    for i, name in enumerate(ordered + lazy):
+        if name in on_demand:
+            continue
+        if name in constants:
+            namespace[f'c{i}'] = constants[name]
+            lines.append(f'    this.{name} = c{i}')
+        elif name in lazy:
+            # the field may have been generated already, if a previous
+            # field used it
+            lines.append(f'    this.{name}')
+        else:
+            lines.append(f'    this.{name} = {getters[name]}()')
+
+    exec(compile('\n'.join(lines), f'<{item.name} builder>', 'exec'),
+         namespace)
+    return namespace['build']
+
+
+def compile_db_values(item):
+    """
+    Compile the function returning the values of an object to write in
+    the database, with the value of the constant fields inlined:
+
+        def db_values(obj):
+            return (obj.name, c1)
+    """
+    constants = item.constant_fields
+    namespace = {}
+    values = []
+    for i, name in enumerate(item.db_fields):
+        if name in constants:
+            namespace[f'c{i}'] = constants[name]
+            values.append(f'c{i}, ')
+        else:
+            values.append(f'obj.{name}, ')
+
+    source = 'def db_values(obj):\n    return ({})'.format(''.join(values))
+    exec(compile(source, f'<{item.name} db_values>', 'exec'), namespace)
+    return namespace['db_values']
+
+
+def _get_row_value(field, context):
+    field.seed_row(context.this._row)
+    return next(field)
+
+
 class ItemFactory:
 
     def __init__(self, item, parent=None):
         self.item = item
         self.blueprint = item.blueprint
-        self._generated = {}
-
-        if parent:
-            self._generated[item.count.by] = parent
-
-    def __getattribute__(self, name):
-        try:
-            return super().__getattribute__(name)
-        except AttributeError:
-            generated = self._generated
-
-            if name in generated:
-                return generated[name]
-            elif name in self.item.fields:
-                value = self._get_value(name)
-                generated[name] = value
-                return value
-            else:
-                raise
-
-    def generate(self):
-        obj = self.item.namedtuple._make(
-            getattr(self, name) for name in self.item.namedtuple._fields
-        )
-        self.clear()
-        return obj
+        self.parent = parent
+        self.prepare()
 
-    def clear(self):
-        parent = self.item.count.by
-        if parent:
-            self._generated = {parent: self._generated[parent]}
+    def prepare(self, size=None):
+        if self.blueprint.random_access:
+            # the values of each row are drawn from the streams of the
+            # fields seeded from the row of 'this' (see
+            # `BaseGenerator.seed_row`)
+            context = self.blueprint.context
+            self.getters = {
+                name: partial(_get_row_value, field, context)
+                for name, field in self.item.fields.items()
+            }
         else:
-            self._generated = {}
+            # use the values generated by batches when a size is given,
+            # or generate them one by one
+            batched = self.item.batched_fields if size is not None else {}
+            self.getters = {
+                name: (
+                    iter(field.get_batch(size)).__next__ if name in batched
+                    else field.__next__
+                )
+                for name, field in self.item.fields.items()
+            }
+        self._getters = tuple(
+            self.getters[name] for name in self.item.generated_fields
+        )
+
+    def generate(self, row=None):
+        this = new(self.item.object_class)
+        this._factory = self
+        if row is not None:
+            this._row = row
+
+        context = self.blueprint.context
+        previous, context.this = context.this, this
+        self.item.builder(this, self._getters, self.parent)
+        context.this = previous
+
+        if not self.item.used_on_demand_fields:
+            # all the fields used are generated, don't keep the
+            # factory alive
+            this._factory = None
+        return this
+
+
+def compile_column_appender(item):
+    """
+    Compile the function appending the values of an object to write in
+    the database to the lists of their columns. The constant fields are
+    not appended, their column is built when written:
+
+        def append(obj, appends):
+            (a0, a1) = appends
+            a0(obj.name)
+    """
+    constants = item.constant_fields
+    names = [name for name in item.db_fields if name not in constants]
+    lines = ['def append(obj, appends):']
+    lines.append('    ({}) = appends'.format(
+        ''.join(f'a{i}, ' for i in range(len(item.db_fields)))
+    ))
+    for i, name in enumerate(item.db_fields):
+        if name not in constants:
+            lines.append(f'    a{i}(obj.{name})')
+    if not names:
+        lines.append('    pass')
 
-    def _get_value(self, name):
-        return next(self.item.fields[name])
+    namespace = {}
+    exec(compile('\n'.join(lines), f'<{item.name} column appender>',
+                 'exec'), namespace)
+    return namespace['append']
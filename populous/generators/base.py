@@ -1,15 +1,41 @@
+import hashlib
 import random
+import zlib
+from itertools import islice
 
 from faker import Factory
 
 from populous.bloom import BloomFilter
 from populous.compat import cached_property
+from populous.compat import numpy
 from populous.exceptions import GenerationError
 from populous.exceptions import ValidationError
+from populous.factory import BaseObject
 from populous.vars import Expression
 from populous.vars import parse_vars
 
 fake = Factory.create()
+np_random = numpy.random.default_rng() if numpy else None
+
+
+def derive_seed(seed, *names):
+    # a 64 bits seed derived from the seed of the blueprint and some names
+    # (like those of an item and a field), to get independent streams
+    data = '\x00'.join(str(part) for part in (seed,) + names).encode()
+    return int.from_bytes(hashlib.sha256(data).digest()[:8], 'little')
+
+
+def seed_shared_generators(seed):
+    # Seed the random generators shared by the whole generation: the
+    # 'random' module (used by the counts, and by the 'random' filter out
+    # of the fields), the numpy generator and the Faker instance (used by
+    # the expressions).
+    random.seed(derive_seed(seed, 'random'))
+    fake.seed_instance(derive_seed(seed, 'faker'))
+    if numpy:
+        np_random.bit_generator.state = numpy.random.default_rng(
+            derive_seed(seed, 'numpy')
+        ).bit_generator.state
 
 
 class BaseGenerator:
@@ -41,6 +67,111 @@ class BaseGenerator:
     def generate(self):
         raise NotImplementedError()
 
+    def get_batch(self, size):
+        return self.generate_batch(size)
+
+    def generate_batch(self, size):
+        # Return a list of 'size' new values.
+        # By default the values are taken one by one from 'generate', but
+        # generators able to create several values at once should
+        # override this method.
+        return list(islice(self.batch_iterator, size))
+
+    @cached_property
+    def batch_iterator(self):
+        return iter(self.generate())
+
+    # The random generators of the field: the shared ones, or when the
+    # blueprint has a seed, generators of its own seeded from the names
+    # of the item and of the field, so that the values of a field don't
+    # depend on the other fields.
+
+    @cached_property
+    def random(self):
+        seed = self.blueprint.seed
+        if seed is None:
+            return random
+        return random.Random(
+            derive_seed(seed, self.item.name, self.field_name)
+        )
+
+    @cached_property
+    def np_random(self):
+        seed = self.blueprint.seed
+        if seed is None or numpy is None:
+            return np_random
+        return numpy.random.default_rng(
+            derive_seed(seed, self.item.name, self.field_name, 'numpy')
+        )
+
+    @cached_property
+    def fake(self):
+        seed = self.blueprint.seed
+        if seed is None:
+            return fake
+        generator = Factory.create()
+        generator.seed_instance(
+            self.row_seed or
+            derive_seed(seed, self.item.name, self.field_name, 'faker')
+        )
+        return generator
+
+    @cached_property
+    def null_random(self):
+        # the stream drawing the null values of the batches, apart from
+        # the stream of the values so that they don't depend on the size
+        # of the batches
+        seed = self.blueprint.seed
+        if seed is None:
+            return np_random if numpy else random
+        seed = derive_seed(seed, self.item.name, self.field_name, 'null')
+        if numpy:
+            return numpy.random.default_rng(seed)
+        return random.Random(seed)
+
+    row_seed = None
+
+    def seed_row(self, row):
+        # In the random access mode, the streams of the field are seeded
+        # before generating the value of each row, so that the value only
+        # depends on the seed, the item, the field and the row.
+        seed = self.row_seed = derive_seed(
+            self.blueprint.seed, self.item.name, self.field_name, *row
+        )
+        self.random.seed(seed)
+        if 'fake' in self.__dict__:
+            self.fake.seed_instance(seed)
+
+    @cached_property
+    def expressions(self):
+        # all the expressions used in the arguments of the generator
+        def _find(value):
+            if isinstance(value, Expression):
+                yield value
+            elif isinstance(value, (list, tuple)):
+                for e in value:
+                    yield from _find(e)
+
+        return tuple(
+            expression for value in vars(self).values()
+            for expression in _find(value)
+        )
+
+    def is_batchable(self):
+        # The values can be generated by batches only if they don't
+        # depend on the current object or on values changing during
+        # the generation.
+        dynamic_vars = self.blueprint.dynamic_vars
+        return not any(
+            expression.variables & dynamic_vars
+            for expression in self.expressions
+        )
+
+    def is_constant(self):
+        # Can the value be generated once for the whole generation?
+        # Only the generators returning a fixed value can tell.
+        return False
+
     def get_arguments(self, shadow=False, **kwargs):
         # should this field be written in the table?
         self.shadow = shadow
@@ -56,7 +187,13 @@ class BaseGenerator:
 
     def evaluate(self, value):
         if isinstance(value, Expression):
-            return value.evaluate(**self.blueprint.vars)
+            # the 'random' filter uses the random generator of the field
+            context = self.blueprint.context
+            previous, context.random = context.random, self.random
+            try:
+                return value.evaluate_in(context)
+            finally:
+                context.random = previous
         return value
 
     def parse_vars(self, value):
@@ -83,14 +220,45 @@ class NullableMixin:
     def generate_with_null(self):
         generator = super().get_generator()
         while True:
-            if random.random() <= self.evaluate(self.nullable):
+            if self.random.random() <= self.evaluate(self.nullable):
                 yield None
             else:
                 yield next(generator)
 
+    def get_batch(self, size):
+        if not self.nullable:
+            return super().get_batch(size)
+
+        nullable = self.evaluate(self.nullable)
+        if numpy:
+            nulls = (self.null_random.random(size) <= nullable).tolist()
+        else:
+            nulls = [
+                self.null_random.random() <= nullable for _ in range(size)
+            ]
+        values = iter(super().get_batch(nulls.count(False)))
+        return [None if null else next(values) for null in nulls]
+
+
+def in_partition(value, key, partition):
+    # Is the unique value owned by this process, when the unique values
+    # are shared between several processes (see `Blueprint.partition`)?
+    # The partition of a value must be the same in all the processes.
+    if isinstance(value, BaseObject):
+        # the objects are those generated by this process
+        return True
+    index, count = partition
+    if type(key) is int:
+        return key % count == index
+    return zlib.crc32(repr(key).encode()) % count == index
+
 
 class UniquenessMixin:
     MAX_TRIES = 10000
+    # Do the generators only draw the unique values of the partition of
+    # this process (see `get_partition`)? The values of the other
+    # generators are rejected when they are not in the partition.
+    builds_partition = False
 
     def get_arguments(self, unique=False, **kwargs):
         super().get_arguments(**kwargs)
@@ -112,32 +280,105 @@ class UniquenessMixin:
             return self.generate_uniquely()
         return super().get_generator()
 
+    def is_batchable(self):
+        # the values of 'unique_with' are those of the current object
+        return super().is_batchable() and not self.unique_with
+
+    def get_batch(self, size):
+        if self.unique:
+            return self.generate_batch_uniquely(size)
+        return super().get_batch(size)
+
+    @cached_property
+    def partitioned(self):
+        # Are the unique values shared between the processes (see
+        # `in_partition`)? Only the values drawn by the generator itself
+        # are: the keys using 'unique_with', and the values taken from
+        # the current object or from the stores, only depend on the
+        # objects of each process.
+        dynamic_vars = self.blueprint.dynamic_vars
+        return not self.unique_with and not any(
+            expression.variables & dynamic_vars
+            for expression in self.expressions
+        )
+
+    def get_partition(self):
+        # the partition of the unique values of this process, if any
+        return self.blueprint.partition if self.partitioned else None
+
+    def get_steps(self, min_, max_):
+        # The integers are 'start + step * k', with 'k' in [0, last].
+        # When the unique values are shared between several processes,
+        # each process only draws the integers of its residue class.
+        partition = self.get_partition()
+        if not partition or not self.unique:
+            return min_, 1, max_ - min_
+
+        index, count = partition
+        start = min_ + (index - min_) % count
+        if start > max_:
+            raise GenerationError(
+                "Item '{}', field '{}': There is no unique value between "
+                "{} and {} for this worker."
+                .format(self.item.name, self.field_name, min_, max_)
+            )
+        return start, count, (max_ - start) // count
+
+    def _get_rejected_partition(self):
+        # the partition whose values are rejected, if not built
+        return None if self.builds_partition else self.get_partition()
+
     def generate_uniquely(self):
         seen = self.seen
-        unique_with = self.unique_with
+        partition = self._get_rejected_partition()
         tries = 0
         for value in super().get_generator():
-            if isinstance(value, tuple) and hasattr(value, 'id'):
-                key = value.id
-            else:
-                key = value
-            if unique_with:
-                this = self.blueprint.vars['this']
-                key = (key,) + tuple(getattr(this, f) for f in unique_with)
-            if key in seen:
-                tries += 1
-                if tries > self.MAX_TRIES:
-                    raise GenerationError(
-                        "Item '{}', field '{}': Could not generate a "
-                        "new unique value in {} tries. Aborting."
-                        .format(self.item.name, self.field_name,
-                                self.MAX_TRIES)
-                    )
+            key = self.get_unique_key(value)
+            if key in seen or (
+                    partition and not in_partition(value, key, partition)):
+                tries = self._check_tries(tries + 1)
                 continue
             tries = 0
             seen.add(key, check=False)
             yield value
 
+    def generate_batch_uniquely(self, size):
+        seen = self.seen
+        partition = self._get_rejected_partition()
+        tries = 0
+        values = []
+        while len(values) < size:
+            for value in super().get_batch(size - len(values)):
+                key = self.get_unique_key(value)
+                if key in seen or (
+                        partition and
+                        not in_partition(value, key, partition)):
+                    tries = self._check_tries(tries + 1)
+                    continue
+                tries = 0
+                seen.add(key, check=False)
+                values.append(value)
+        return values
+
+    def get_unique_key(self, value):
+        if isinstance(value, BaseObject):
+            key = value.id
+        else:
+            key = value
+        if self.unique_with:
+            this = self.blueprint.context['this']
+            key = (key,) + tuple(getattr(this, f) for f in self.unique_with)
+        return key
+
+    def _check_tries(self, tries):
+        if tries > self.MAX_TRIES:
+            raise GenerationError(
+                "Item '{}', field '{}': Could not generate a "
+                "new unique value in {} tries. Aborting."
+                .format(self.item.name, self.field_name, self.MAX_TRIES)
+            )
+        return tries
+
 
 class Generator(NullableMixin, UniquenessMixin, BaseGenerator):
     pass
@@ -1,5 +1,4 @@
-import random
-
+from populous.compat import numpy
 from .base import Generator
 
 
@@ -12,4 +11,9 @@ class Boolean(Generator):
 
     def generate(self):
         while True:
-            yield random.random() <= self.ratio
+            yield self.random.random() <= self.ratio
+
+    def generate_batch(self, size):
+        if numpy is None:
+            return super().generate_batch(size)
+        return (self.np_random.random(size) <= self.ratio).tolist()
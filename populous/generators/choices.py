@@ -1,5 +1,4 @@
-import random
-
+from populous.compat import numpy
 from populous.exceptions import GenerationError
 
 from .base import Generator
@@ -31,12 +30,20 @@ class Choices(Generator):
         while True:
             yield generator()
 
+    def generate_batch(self, size):
+        if numpy is None or self.from_var or not self.choices:
+            return super().generate_batch(size)
+
+        choices = self.choices
+        indexes = self.np_random.integers(len(choices), size=size).tolist()
+        return [self.evaluate(choices[index]) for index in indexes]
+
     def _generate_from_list(self):
-        return self.evaluate(random.choice(self.choices))
+        return self.evaluate(self.random.choice(self.choices))
 
     def _generate_from_var(self):
         try:
-            return random.choice(self.evaluate(self.choices))
+            return self.random.choice(self.evaluate(self.choices))
         except IndexError:
             if self.nullable:
                 return None
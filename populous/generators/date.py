@@ -1,4 +1,3 @@
-import random
 from datetime import date
 from datetime import datetime
 from time import mktime, gmtime
@@ -6,6 +5,7 @@ from time import mktime, gmtime
 from dateutil.parser import parse as dateutil_parse
 from dateutil.tz import tzlocal
 
+from populous.compat import numpy
 from .base import Generator
 
 
@@ -28,6 +28,7 @@ def parse_datetime(candidate):
 
 
 class DateTime(Generator):
+    builds_partition = True
 
     epoch_year = gmtime(0).tm_year
 
@@ -40,9 +41,9 @@ class DateTime(Generator):
         self.after = self.parse_vars(after)
         self.before = self.parse_vars(before)
 
-    def generate(self):
+    def get_range(self):
         if not self.past:
-            start = to_timestamp(datetime.now())
+            start = to_timestamp(self.blueprint.now)
         else:
             # try not to go too far in the past
             start = to_timestamp(datetime(self.epoch_year, 1, 1))
@@ -51,7 +52,7 @@ class DateTime(Generator):
             # try not to go too far in the future
             stop = to_timestamp(datetime(2100, 1, 1))
         else:
-            stop = to_timestamp(datetime.now())
+            stop = to_timestamp(self.blueprint.now)
 
         if self.before:
             stop = to_timestamp(parse_datetime(self.evaluate(self.before)))
@@ -59,14 +60,55 @@ class DateTime(Generator):
         if self.after:
             start = to_timestamp(parse_datetime(self.evaluate(self.after)))
 
+        return int(start), int(stop)
+
+    def get_bounds(self):
+        # the range of the values, as integers (see `from_integer`)
+        return self.get_range()
+
+    def from_integer(self, value):
+        return self.from_timestamp(value)
+
+    def from_timestamp(self, timestamp):
+        return datetime.fromtimestamp(timestamp)
+
+    def generate(self):
+        start, step, last = self.get_steps(*self.get_bounds())
+        randint = self.random.randint
+
         while True:
-            yield datetime.fromtimestamp(
-                random.randint(start, stop)
-            )
+            yield self.from_integer(start + step * randint(0, last))
+
+    def generate_batch(self, size):
+        if numpy is None:
+            return super().generate_batch(size)
+
+        start, step, last = self.get_steps(*self.get_bounds())
+        values = self.np_random.integers(0, last, size=size, endpoint=True)
+        if step != 1:
+            values = values * step
+        return list(map(self.from_integer, (values + start).tolist()))
 
 
 class Date(DateTime):
 
-    def generate(self):
-        for dt in super().generate():
-            yield dt.date()
+    @property
+    def by_day(self):
+        # the unique dates shared between several processes are drawn by
+        # day, so that each process owns its days (see `get_steps`)
+        return bool(self.unique and self.get_partition())
+
+    def get_bounds(self):
+        start, stop = self.get_range()
+        if not self.by_day:
+            return start, stop
+        return (date.fromtimestamp(start).toordinal(),
+                date.fromtimestamp(stop).toordinal())
+
+    def from_integer(self, value):
+        if self.by_day:
+            return date.fromordinal(value)
+        return self.from_timestamp(value)
+
+    def from_timestamp(self, timestamp):
+        return datetime.fromtimestamp(timestamp).date()
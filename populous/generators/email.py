@@ -1,8 +1,17 @@
-from .base import Generator, fake
+from .base import Generator
 
 
 class Email(Generator):
+    builds_partition = True
 
     def generate(self):
+        # When the unique values are shared between several processes,
+        # the name of their mailbox ends with the index of the partition
+        # of this process.
+        partition = self.get_partition() if self.unique else None
         while True:
-            yield fake.email()
+            email = self.fake.email()
+            if partition:
+                name, domain = email.rsplit('@', 1)
+                email = f'{name}.{partition[0]}@{domain}'
+            yield email
@@ -1,10 +1,13 @@
-import random
-
+from populous.compat import numpy
 from populous.vars import parse_vars
 from .base import Generator
 
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+
 
 class Integer(Generator):
+    builds_partition = True
 
     def get_arguments(self, min=0, max=(2 ** 32) - 1, to_string=False,
                       **kwargs):
@@ -19,9 +22,26 @@ class Integer(Generator):
             return (str(e) for e in self._generate())
         return self._generate()
 
+    def generate_batch(self, size):
+        min_, max_ = self.evaluate(self.min), self.evaluate(self.max)
+        if numpy is None or not INT64_MIN <= min_ <= max_ <= INT64_MAX:
+            return super().generate_batch(size)
+
+        start, step, last = self.get_steps(min_, max_)
+        if last > INT64_MAX:
+            return super().generate_batch(size)
+        values = self.np_random.integers(0, last, size=size, endpoint=True)
+        if step != 1:
+            values = values * step
+        values = (values + start).tolist()
+        if self.to_string:
+            return list(map(str, values))
+        return values
+
     def _generate(self):
+        randint = self.random.randint
         while True:
-            yield random.randint(
-                self.evaluate(self.min),
-                self.evaluate(self.max)
+            start, step, last = self.get_steps(
+                self.evaluate(self.min), self.evaluate(self.max)
             )
+            yield start + step * randint(0, last)
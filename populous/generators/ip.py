@@ -1,6 +1,4 @@
-import random
-
-from .base import Generator, fake
+from .base import Generator
 
 
 class IP(Generator):
@@ -20,15 +18,15 @@ class IP(Generator):
 
     def generate_ipv4(self):
         while True:
-            yield fake.ipv4()
+            yield self.fake.ipv4()
 
     def generate_ipv6(self):
         while True:
-            yield fake.ipv6()
+            yield self.fake.ipv6()
 
     def generate_both(self):
         while True:
-            if random.random() >= 0.5:
-                yield fake.ipv4()
+            if self.random.random() >= 0.5:
+                yield self.fake.ipv4()
             else:
-                yield fake.ipv6()
+                yield self.fake.ipv6()
@@ -1,6 +1,6 @@
 from populous.exceptions import ValidationError
 
-from .base import Generator, fake
+from .base import Generator
 
 
 class Name(Generator):
@@ -21,11 +21,11 @@ class Name(Generator):
             )
 
         if gender == 'F':
-            return fake.name_female
+            return self.fake.name_female
         elif gender == 'M':
-            return fake.name_male
+            return self.fake.name_male
         else:
-            return fake.name
+            return self.fake.name
 
     def generate(self):
         provider = self._get_provider()
@@ -40,11 +40,11 @@ class FirstName(Name):
 
     def _get_provider(self):
         if self.gender == 'F':
-            return fake.first_name_female
+            return self.fake.first_name_female
         elif self.gender == 'M':
-            return fake.first_name_male
+            return self.fake.first_name_male
         else:
-            return fake.first_name
+            return self.fake.first_name
 
 
 class LastName(Generator):
@@ -56,7 +56,7 @@ class LastName(Generator):
 
     def generate(self):
         while True:
-            name = fake.last_name()
+            name = self.fake.last_name()
             if self.max_length and len(name) > self.max_length:
                 continue
             yield name
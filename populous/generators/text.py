@@ -1,6 +1,4 @@
 import array
-import os
-import random
 
 from string import ascii_letters
 from string import ascii_lowercase
@@ -9,12 +7,14 @@ from string import digits
 from string import printable
 from string import punctuation
 
+from populous.exceptions import GenerationError
 from populous.vars import parse_vars
 
 from .base import Generator
 
 
 class Text(Generator):
+    builds_partition = True
 
     def get_arguments(self, min_length=0, max_length=None, chars='<a-Z><0-9> ',
                       **kwargs):
@@ -46,19 +46,57 @@ class Text(Generator):
 
         return description
 
+    def get_prefix(self):
+        # When the unique values are shared between several processes,
+        # they start with the index of the partition of this process,
+        # written with the chars.
+        partition = self.get_partition()
+        if not partition or not self.unique:
+            return ''
+
+        index, count = partition
+        chars = sorted(set(self.chars))
+        if len(chars) < 2:
+            raise GenerationError(
+                "Item '{}', field '{}': The unique values cannot be shared "
+                "between several workers with less than 2 chars."
+                .format(self.item.name, self.field_name)
+            )
+        prefix = ''
+        while count > 1:
+            index, digit = divmod(index, len(chars))
+            count = -(-count // len(chars))
+            prefix += chars[digit]
+        return prefix
+
     def generate(self):
         chars = self.chars
         nb_chars = len(chars)
+        prefix = self.get_prefix()
 
         while True:
             # get a random length for the string
-            length = random.randint(
-                self.evaluate(self.min_length),
-                self.evaluate(self.max_length)
-            )
+            min_length = self.evaluate(self.min_length)
+            max_length = self.evaluate(self.max_length)
+            if max_length < len(prefix):
+                raise GenerationError(
+                    "Item '{}', field '{}': There is no unique value of "
+                    "{} chars at most for this worker."
+                    .format(self.item.name, self.field_name, max_length)
+                )
+            length = self.random.randint(
+                max(min_length, len(prefix)), max_length
+            ) - len(prefix)
             # get a random array of short integers of the same length than
             # the final string
-            rand_shorts = array.array('H', os.urandom(length * 2))
+            rand_shorts = array.array('H', self._random_bytes(length * 2))
             # for each short in the array, get an element from the list
             # of possible chars
-            yield ''.join([chars[short % nb_chars] for short in rand_shorts])
+            yield prefix + ''.join(
+                [chars[short % nb_chars] for short in rand_shorts]
+            )
+
+    def _random_bytes(self, size):
+        if not size:
+            return b''
+        return self.random.getrandbits(size * 8).to_bytes(size, 'little')
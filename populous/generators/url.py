@@ -1,8 +1,8 @@
-from .base import Generator, fake
+from .base import Generator
 
 
 class URL(Generator):
 
     def generate(self):
         while True:
-            yield fake.url().rstrip('/')
+            yield self.fake.url().rstrip('/')
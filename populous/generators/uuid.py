@@ -1,9 +1,13 @@
 import uuid
 
+from populous.compat import numpy
 from .base import Generator
 
 
 class UUID(Generator):
+    # the random UUIDs are not shared between the processes: with their
+    # 122 random bits, they don't collide
+    partitioned = False
 
     def get_arguments(self, to_string=False, **kwargs):
         super().get_arguments(**kwargs)
@@ -16,6 +20,20 @@ class UUID(Generator):
 
         return self._generate()
 
+    def generate_batch(self, size):
+        if numpy is None:
+            return super().generate_batch(size)
+
+        data = self.np_random.bytes(16 * size)
+        values = [
+            uuid.UUID(bytes=data[i:i + 16], version=4)
+            for i in range(0, 16 * size, 16)
+        ]
+        if self.to_string:
+            return list(map(str, values))
+        return values
+
     def _generate(self):
+        getrandbits = self.random.getrandbits
         while True:
-            yield uuid.uuid4()
+            yield uuid.UUID(int=getrandbits(128), version=4)
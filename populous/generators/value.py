@@ -11,3 +11,16 @@ class Value(Generator):
     def generate(self):
         while True:
             yield self.evaluate(self.value)
+
+    def is_constant(self):
+        # the value never changes if it does not depend on the current
+        # object nor on values changing during the generation, and if
+        # its expressions have no randomness
+        if self.nullable or self.unique:
+            return False
+        dynamic_vars = self.blueprint.dynamic_vars
+        return all(
+            expression.deterministic and
+            not expression.variables & dynamic_vars
+            for expression in self.expressions
+        )
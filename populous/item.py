@@ -1,21 +1,38 @@
 import copy
 import logging
 import random
+import re
 from collections import OrderedDict
 from collections import namedtuple
+from itertools import chain
+
+from jinja2.utils import consume
 
 from populous import generators
 from populous.compat import cached_property
+from populous.compat import numpy
 from populous.exceptions import ValidationError
+from populous.factory import BaseObject
 from populous.factory import ItemFactory
+from populous.factory import compile_builder
+from populous.factory import compile_column_appender
+from populous.factory import compile_db_values
+from populous.generators.base import derive_seed
+from populous.generators.base import np_random
+from populous.stores import KeyedStore
+from populous.stores import Pending
+from populous.stores import Store
 from populous.vars import Expression
 from populous.vars import ValueExpression
 from populous.vars import parse_vars
 
 logger = logging.getLogger('populous')
 
-ITEM_KEYS = ('name', 'parent', 'table', 'count', 'fields', 'store_in')
+ITEM_KEYS = (
+    'name', 'parent', 'table', 'count', 'fields', 'store_in', 'batch_size'
+)
 COUNT_KEYS = ('number', 'by', 'min', 'max')
+KEYED_STORE_REGEX = re.compile(r'^([a-zA-Z_][a-zA-Z0-9_]*)\[(.+)\]$')
 
 
 class Item:
@@ -42,8 +59,13 @@ class Item:
             number=0, by=None, min=None, max=None, blueprint=blueprint
         )
         self.fields = OrderedDict()
+        # the number of objects written at once, 'auto' to let the buffer
+        # tune it, or None to use the default of the buffer
+        self.batch_size = parent.batch_size if parent else None
         self._store_in = store_in
         self._set_store_in(store_in)
+        # the stored values waiting for the id of their object, by object
+        self.pending = {}
 
         self.add_field('id', 'Value', value=None, shadow=True)
 
@@ -63,11 +85,176 @@ class Item:
             self.ancestors = []
 
     @cached_property
-    def namedtuple(self):
+    def object_class(self):
         fields = tuple(self.fields.keys())
         if self.count.by:
             fields += (self.count.by,)
-        return namedtuple(self.name, fields)
+        return type(self.name, (BaseObject,), {'__slots__': fields})
+
+    @cached_property
+    def builder(self):
+        return compile_builder(self)
+
+    @cached_property
+    def ordered_fields(self):
+        # Sort the fields so that each one is generated after the fields
+        # it uses (through '$this.<field>' or 'unique_with').
+        # The fields using 'this' as a whole can use any other field, they
+        # are generated last, and the fields they need are generated
+        # on access.
+        dependencies = {}
+        lazy = []
+        for name, field in self.fields.items():
+            used = set(getattr(field, 'unique_with', None) or ())
+            for expression in field.expressions:
+                for path in expression.references:
+                    if path[0] != 'this':
+                        continue
+                    if len(path) == 1:
+                        if name not in lazy:
+                            lazy.append(name)
+                    else:
+                        used.add(path[1])
+            dependencies[name] = [f for f in self.fields if f in used]
+
+        ordered = []
+
+        def _visit(name, visiting):
+            if name in ordered or name in lazy:
+                return
+            if name in visiting:
+                raise ValidationError(
+                    "Item '{}': Circular reference between the fields "
+                    "'{}'.".format(self.name, "', '".join(visiting))
+                )
+            for dependency in dependencies[name]:
+                _visit(dependency, visiting + [name])
+            ordered.append(name)
+
+        for name in self.fields:
+            _visit(name, [])
+
+        return ordered, lazy
+
+    @cached_property
+    def constant_fields(self):
+        # The fields whose value is the same for all the objects: their
+        # value is computed once and inlined in the objects.
+        return OrderedDict(
+            (name, next(field)) for name, field in self.fields.items()
+            if field.is_constant()
+        )
+
+    @cached_property
+    def on_demand_fields(self):
+        # The shadow fields are not written, they are only generated when
+        # they are used, and never if they are not used at all.
+        return [
+            name for name, field in self.fields.items()
+            if field.shadow and name != 'id' and
+            name not in self.constant_fields
+        ]
+
+    @cached_property
+    def used_on_demand_fields(self):
+        # the fields generated on demand which may be used by an
+        # expression, after the object has been built
+        referenced = self.blueprint.referenced_attributes
+        return [name for name in self.on_demand_fields if name in referenced]
+
+    @cached_property
+    def generated_fields(self):
+        # the fields generated for each object, in the order of the builder
+        ordered, lazy = self.ordered_fields
+        return [
+            name for name in ordered + lazy
+            if name not in self.constant_fields and
+            name not in self.on_demand_fields
+        ]
+
+    @cached_property
+    def batched_fields(self):
+        return OrderedDict(
+            (name, self.fields[name]) for name in self.generated_fields
+            if self.fields[name].is_batchable()
+        )
+
+    @cached_property
+    def expressions(self):
+        # all the expressions used by the item
+        expressions = []
+        for field in self.fields.values():
+            expressions.extend(field.expressions)
+        for value in (self.count.number, self.count.min, self.count.max):
+            if isinstance(value, Expression):
+                expressions.append(value)
+        for name_expr, value_expr in self.store_in_item.items():
+            expressions += [name_expr, value_expr]
+        expressions.extend(self.store_in_global.values())
+        expressions.extend(self.store_in_keys.values())
+        return [e for e in expressions if isinstance(e, Expression)]
+
+    @cached_property
+    def needed_items(self):
+        # The other items storing objects used by this one: they must be
+        # written before generating this item, so that the ids of the
+        # stored objects are known.
+        variables = set()
+        for field in self.fields.values():
+            for expression in field.expressions:
+                variables |= expression.variables
+        for value in (self.count.number, self.count.min, self.count.max):
+            if isinstance(value, Expression):
+                variables |= value.variables
+
+        needed = []
+        for item in self.blueprint.items.values():
+            if item is self:
+                continue
+            targets = {
+                expr.attrs.rsplit('.')[-2] for expr in item.store_in_item
+            }
+            if (variables & set(item.store_in_global) or
+                    (self.count.by and self.count.by in targets)):
+                needed.append(item)
+        return needed
+
+    @cached_property
+    def deferred_store_in(self):
+        # The 'store_in' values using the id of the stored object: they
+        # are only evaluated once the object is written. The other values
+        # are final as soon as the object is generated (the objects
+        # themselves get their id in place).
+        return frozenset(
+            key for key, expression in chain(
+                self.store_in_global.items(), self.store_in_item.items()
+            )
+            if uses_id(expression)
+        )
+
+    @cached_property
+    def offloadable(self):
+        # Can the objects be written by the loader processes (see
+        # `populous.pipeline`)? Their ids must not be used once they are
+        # written (by the items generated for them, or through the
+        # stores), and they must not reference the objects of this
+        # generation (their parent, or the objects and ids of the stores),
+        # which the connections of the loaders cannot see before the
+        # transaction is committed.
+        if self.blueprint.dependents[self.name] or self._store_in:
+            return False
+        if self.count.by:
+            return False
+        dynamic_vars = self.blueprint.dynamic_vars - {'this'}
+        return not any(
+            expression.variables & dynamic_vars
+            for field in self.fields.values()
+            for expression in field.expressions
+        )
+
+    def write_needed_items(self, buffer):
+        for item in self.needed_items:
+            buffer.write(item)
 
     @cached_property
     def db_fields(self):
@@ -78,17 +265,40 @@ class Item:
     def _set_store_in(self, store_in):
         if not store_in:
             self.store_in_global = {}
+            self.store_in_keys = {}
             self.store_in_item = {}
             return
 
-        self.store_in_global = {
-            name: parse_vars(expression)
-            for name, expression in store_in.items()
-            if not name.startswith('this.')
-        }
+        self.store_in_global = {}
+        # the keys of the keyed stores ('name[$key]'), by name
+        self.store_in_keys = {}
+        for name, expression in store_in.items():
+            if name.startswith('this.'):
+                continue
+            match = KEYED_STORE_REGEX.match(name)
+            if match:
+                name, key = match.groups()
+                self.store_in_keys[name] = parse_vars(key)
+            self.store_in_global[name] = parse_vars(expression)
+
         # create the global var in the blueprint
         for name in self.store_in_global:
-            self.blueprint.vars.setdefault(name, [])
+            keyed = name in self.store_in_keys
+            store = self.blueprint.vars.setdefault(
+                name, KeyedStore() if keyed else Store()
+            )
+            if keyed != isinstance(store, KeyedStore):
+                raise ValidationError(
+                    "Error in 'store_in' section in item '{}': The store "
+                    "'{}' is used both with and without a key."
+                    .format(self.name, name)
+                )
+            if keyed and uses_id(self.store_in_keys[name]):
+                raise ValidationError(
+                    "Error in 'store_in' section in item '{}': The key of "
+                    "the store '{}' cannot use the id of the object."
+                    .format(self.name, name)
+                )
 
         self.store_in_item = {
             ValueExpression(name): parse_vars(expression)
@@ -108,6 +318,16 @@ class Item:
                 )
             target.add_field(store_name, 'Store')
 
+    def set_batch_size(self, batch_size):
+        if batch_size != 'auto' and (
+                not isinstance(batch_size, int) or
+                isinstance(batch_size, bool) or batch_size <= 0):
+            raise ValidationError(
+                "Item '{}': The batch size must be a positive integer or "
+                "'auto' (got: '{}').".format(self.name, batch_size)
+            )
+        self.batch_size = batch_size
+
     def add_field(self, name, generator, **params):
         if not generator:
             parent_field = self.fields.get(name, None)
@@ -134,6 +354,8 @@ class Item:
                 .format(self.name, name, generator)
             )
         self.fields[name] = generator_cls(self, name, **params)
+        # the order of the fields will be computed again with the new field
+        self.__dict__.pop('ordered_fields', None)
 
     def add_count(self, number=None, by=None, min=None, max=None):
         number = parse_vars(number)
@@ -221,87 +443,138 @@ class Item:
     def batch_written(self, buffer, batch, ids):
         logger.info(f"{len(batch):>5} {self.name} written")
 
-        objs = tuple(e._replace(id=id) for (e, id) in zip(batch, ids))
-        self.store_final_values(objs)
-        self.generate_dependencies(buffer, objs)
+        for obj, id in zip(batch, ids):
+            obj.id = id
+        self.store_final_values(batch)
+        buffer.schedule(self.generate_dependencies(buffer, batch))
 
     def store_final_values(self, objs):
-        # replace the temporary stored objects by the final value
-        # (now that we know computed fields like 'id')
-
-        def _get_values(expression):
-            for obj in objs:
-                self.blueprint.vars['this'] = obj
-                yield expression.evaluate(**self.blueprint.vars)
-            del self.blueprint.vars['this']
-
-        for name, expression in self.store_in_global.items():
-            store = self.blueprint.vars[name]
-            store[-len(objs):] = _get_values(expression)
-
-        for name_expr, value_expr in self.store_in_item.items():
-            stores = {}
-
-            # group the values by each instance of the store,
-            # so that we know how many items we have to update
-            # for each instance
-            for i, obj in enumerate(objs):
-                self.blueprint.vars['this'] = obj
-                store = name_expr.evaluate(**self.blueprint.vars)
-                value = value_expr.evaluate(**self.blueprint.vars)
-
-                holder = stores.setdefault(id(store), (store, []))
-                holder[1].append(value)
-
-            del self.blueprint.vars['this']
+        # replace the values stored while the id of the objects was not
+        # known by their final value
+        pending = self.pending
+        if not pending:
+            return
 
-            # now that we have separated the different instance,
-            # we can update the last values
-            for store, values in stores.values():
-                store[-len(values):] = values
+        context = self.blueprint.context
+        for obj in objs:
+            values = pending.pop(obj, None)
+            if values:
+                context.this = obj
+                for value in values:
+                    value.resolve(context)
+        context.this = None
 
     def store_value(self, obj):
-        self.blueprint.vars['this'] = obj
+        context = self.blueprint.context
+        context.this = obj
+        deferred = self.deferred_store_in
+        pending = []
 
+        keys = self.store_in_keys
         for name, expression in self.store_in_global.items():
             store = self.blueprint.vars[name]
-            value = expression.evaluate(**self.blueprint.vars)
+            if name in keys:
+                key = keys[name]
+                if isinstance(key, Expression):
+                    key = key.evaluate_in(context)
+                store = store.get_store(key)
+            if name in deferred:
+                value = Pending(store, len(store), expression)
+                pending.append(value)
+            else:
+                value = expression.evaluate_in(context)
             store.append(value)
 
         for name_expr, value_expr in self.store_in_item.items():
-            store = name_expr.evaluate(**self.blueprint.vars)
-            store.append(value_expr.evaluate(**self.blueprint.vars))
+            store = name_expr.evaluate_in(context)
+            if name_expr in deferred:
+                # the lists of the objects hold None until the value is
+                # known, as they may be read before
+                pending.append(Pending(store, len(store), value_expr))
+                value = None
+            else:
+                value = value_expr.evaluate_in(context)
+            store.append(value)
 
-        del self.blueprint.vars['this']
+        if pending:
+            self.pending[obj] = pending
+        context.this = None
 
-    def generate(self, buffer, count, parent=None):
-        factory = ItemFactory(self, parent=parent)
+    def generate(self, buffer, count, parent=None, first_row=0):
+        consume(self.generate_batches(
+            buffer, count, parent=parent, first_row=first_row
+        ))
 
-        for i in range(count):
-            self.blueprint.vars['this'] = factory
-            obj = factory.generate()
-            del self.blueprint.vars['this']
+    def generate_batches(self, buffer, count, parent=None, first_row=0):
+        # generate the objects batch by batch, yielding after each batch
+        # so that the buffer can generate the dependencies of the
+        # batches written (see `Buffer.run`)
+        factory = ItemFactory(self, parent=parent)
 
-            self.store_value(obj)
-            buffer.add(obj)
+        # In the random access mode, the rows are identified by their
+        # index, after the row of their parent: their values only depend
+        # on this key (see `BaseGenerator.seed_row`).
+        random_access = self.blueprint.random_access
+        if random_access:
+            parent_row = parent._row if parent is not None else ()
+
+        start = 0
+        while start < count:
+            # the size of the batches may change during the generation
+            size = min(count - start, buffer.sizes[self.name])
+            # generate the values of the batchable fields for a whole batch
+            factory.prepare(size)
+
+            for index in range(first_row + start, first_row + start + size):
+                if random_access:
+                    obj = factory.generate(parent_row + (index,))
+                else:
+                    obj = factory.generate()
+                self.store_value(obj)
+                buffer.add(obj)
+            start += size
+            yield
 
     def generate_dependencies(self, buffer, batch):
-        # generate items having a "count by" on this item
-        # or one of its ancestors
-        names = frozenset(self.ancestors) | {self.name}
-        for item in self.blueprint.items.values():
-            by = item.count.by
-            if by in names:
-                for obj in batch:
-                    self.blueprint.vars[by] = obj
-                    count = item.count()
-                    del self.blueprint.vars[by]
-                    if count:
-                        item.generate(buffer, count, parent=obj)
-                buffer.write(item)
+        # Generate items having a "count by" on this item
+        # or one of its ancestors.
+        # This is an iterator run by the buffer, yielding each time a
+        # batch may have been written.
+        # The objects generated are only written when their batch is
+        # full, or at the end of the generation: the batches of a few
+        # objects per parent are merged.
+        for item in self.blueprint.dependents[self.name]:
+            item.write_needed_items(buffer)
+            counts = item.count.batch(batch, item.name)
+            for obj, count in zip(batch, counts):
+                if count:
+                    yield from item.generate_batches(
+                        buffer, count, parent=obj
+                    )
 
-    def db_values(self, obj):
-        return tuple(getattr(obj, field) for field in self.db_fields)
+    @cached_property
+    def db_values(self):
+        # the function returning the values of an object to write
+        return compile_db_values(self)
+
+    @cached_property
+    def append_columns(self):
+        # the function appending the values of an object to write to
+        # the lists of their columns (see `Buffer`)
+        return compile_column_appender(self)
+
+
+def uses_id(expression):
+    # does the expression use the id of 'this'?
+    if not isinstance(expression, Expression):
+        return False
+    if isinstance(expression, ValueExpression) and not expression.attrs:
+        # the object itself
+        return False
+    return any(
+        path[0] == 'this' and (len(path) == 1 or path[1] == 'id')
+        for path in expression.references
+    )
 
 
 class Count(namedtuple('Count', COUNT_KEYS + ('blueprint',))):
@@ -309,10 +582,60 @@ class Count(namedtuple('Count', COUNT_KEYS + ('blueprint',))):
 
     def evaluate(self, value):
         if isinstance(value, Expression):
-            return value.evaluate(**self.blueprint.vars)
+            return value.evaluate_in(self.blueprint.context)
         return value
 
-    def __call__(self):
+    def __call__(self, name=None, row=()):
+        # the count of the item 'name' (for the parent at 'row')
         if self.number is not None:
             return self.evaluate(self.number)
-        return random.randint(self.evaluate(self.min), self.evaluate(self.max))
+        stream = random
+        if self.blueprint.random_access:
+            # drawn from a stream seeded from the row of the parent
+            stream = random.Random(
+                derive_seed(self.blueprint.seed, name, 'count', *row)
+            )
+        return stream.randint(self.evaluate(self.min), self.evaluate(self.max))
+
+    def batch(self, parents, name=None):
+        # Return the counts for each object of a batch of parents of
+        # the item 'name'.
+        # If the count does not depend on the parent nor on values
+        # changing during the generation, all the counts are drawn at once,
+        # otherwise they are evaluated lazily, one parent at a time.
+        if self.blueprint.random_access and self.number is None:
+            # the count of each parent only depends on its row
+            return self._per_parent_row(parents, name)
+
+        dynamic_vars = self.blueprint.dynamic_vars
+        if any(
+            isinstance(value, Expression) and value.variables & dynamic_vars
+            for value in (self.number, self.min, self.max)
+        ):
+            return self._per_parent(parents)
+
+        size = len(parents)
+        if self.number is not None:
+            return [self.evaluate(self.number)] * size
+        min_, max_ = self.evaluate(self.min), self.evaluate(self.max)
+        if numpy:
+            return np_random.integers(
+                min_, max_, size, endpoint=True
+            ).tolist()
+        return [random.randint(min_, max_) for _ in range(size)]
+
+    def _per_parent(self, parents):
+        vars_ = self.blueprint.vars
+        for parent in parents:
+            vars_[self.by] = parent
+            count = self()
+            del vars_[self.by]
+            yield count
+
+    def _per_parent_row(self, parents, name):
+        vars_ = self.blueprint.vars
+        for parent in parents:
+            vars_[self.by] = parent
+            count = self(name, parent._row)
+            del vars_[self.by]
+            yield count
@@ -11,11 +11,15 @@ jinja_env.undefined = jinja2.StrictUndefined
 # same value being generated every time.
 # cf https://github.com/pallets/jinja/pull/478
 
+# The random generator is the one of the populous context, when the
+# expression is evaluated for a field (see `BaseGenerator.evaluate`), so
+# that the values drawn depend on the seed of the field.
+
 @jinja2.pass_context
 def do_random(context, seq):
     """Return a random item from the sequence."""
     try:
-        return random.choice(seq)
+        return getattr(context.parent, 'random', random).choice(seq)
     except IndexError:
         return context.environment.undefined(
             'No random item, sequence was empty.'
@@ -0,0 +1,257 @@
+"""
+Writing the objects in loader processes.
+
+The objects whose id is not used once they are written, and which don't
+reference the other objects of the generation (see `Item.offloadable`),
+don't need to be written by the generating process: their batches are
+encoded by the backend (like the rows of a COPY), and sent through a ring
+buffer in shared memory to loader processes, which load them in the
+database with their own connection.
+
+Once the generation is done, each loader tells when it loaded all its
+batches, and waits: all the loaders commit their transaction if none of
+them failed, or they all roll it back.
+
+The generation and the loading run on different cores. When the loaders
+fall behind, the ring buffer fills up and the generation waits for them.
+"""
+import multiprocessing
+import queue
+import struct
+
+from populous.compat import shared_memory
+from populous.exceptions import GenerationError
+
+# the size of the ring buffer (in bytes)
+RING_SIZE = 64 * 1024 * 1024
+
+# the kinds of messages: a batch to load, or the end of the generation
+LOAD = b'L'
+READY = b'R'
+
+
+class Ring:
+    """
+    A ring buffer of messages in shared memory, shared by processes.
+
+    'head' and 'tail' are the total number of bytes written and read,
+    each message being prefixed by its length.
+    """
+    header = struct.Struct('<Q')
+
+    def __init__(self, size, context):
+        self.size = size
+        self.memory = shared_memory.SharedMemory(create=True, size=size)
+        self.lock = context.Lock()
+        self.not_full = context.Condition(self.lock)
+        self.not_empty = context.Condition(self.lock)
+        self.head = context.Value('Q', 0, lock=False)
+        self.tail = context.Value('Q', 0, lock=False)
+
+    def put(self, data, check=None):
+        # Add a message, waiting for enough space in the ring.
+        # 'check' is called while waiting, to stop when the readers
+        # are gone.
+        message = self.header.pack(len(data)) + data
+        if len(message) > self.size:
+            raise GenerationError(
+                "A batch of {} bytes does not fit in the ring buffer of the "
+                "loaders ({} bytes).".format(len(data), self.size)
+            )
+
+        with self.lock:
+            while self.size - (self.head.value - self.tail.value) < len(
+                    message):
+                if not self.not_full.wait(timeout=1) and check is not None:
+                    check()
+            self._write(self.head.value, message)
+            self.head.value += len(message)
+            self.not_empty.notify()
+
+    def get(self):
+        # Remove the next message, waiting for one.
+        with self.lock:
+            while self.head.value == self.tail.value:
+                self.not_empty.wait()
+            tail = self.tail.value
+            length, = self.header.unpack(
+                self._read(tail, self.header.size)
+            )
+            data = self._read(tail + self.header.size, length)
+            self.tail.value = tail + self.header.size + length
+            self.not_full.notify_all()
+        return data
+
+    def close(self):
+        self.memory.close()
+
+    def unlink(self):
+        self.memory.close()
+        self.memory.unlink()
+
+    def _write(self, position, data):
+        # copy the data at a position, wrapping at the end of the ring
+        buf = self.memory.buf
+        start = position % self.size
+        first = min(len(data), self.size - start)
+        buf[start:start + first] = data[:first]
+        if first < len(data):
+            buf[:len(data) - first] = data[first:]
+
+    def _read(self, position, length):
+        buf = self.memory.buf
+        start = position % self.size
+        first = min(length, self.size - start)
+        data = bytes(buf[start:start + first])
+        if first < length:
+            data += bytes(buf[:length - first])
+        return data
+
+
+class Pipeline:
+    """
+    The loader processes of a generating process, and the ring buffer
+    used to send them the batches.
+    """
+
+    def __init__(self, backend_cls, backend_kwargs, loaders,
+                 size=RING_SIZE):
+        if shared_memory is None:
+            raise GenerationError("The loaders need python>=3.8.")
+
+        context = multiprocessing.get_context('spawn')
+        self.ring = Ring(size, context)
+        self.results = context.Queue()
+        # the decision to commit the transactions of the loaders or not,
+        # once they loaded all their batches
+        self.decided = context.Event()
+        self.decision = context.Value('b', 0)
+        self.processes = [
+            context.Process(
+                target=_run_loader,
+                args=(index, backend_cls, backend_kwargs, self.ring,
+                      self.results, self.decided, self.decision),
+                name=f'populous-loader-{index}',
+                daemon=True,
+            )
+            for index in range(loaders)
+        ]
+        for process in self.processes:
+            process.start()
+        # the errors of the loaders, by index, and those already raised
+        self.errors = {}
+        self.raised = set()
+        self.closed = False
+
+    def load(self, item, data):
+        header = '{}\t{}\n'.format(item.table, ','.join(item.db_fields))
+        self.ring.put(LOAD + header.encode() + data, check=self.check)
+
+    def check(self):
+        # stop the generation if a loader failed
+        self._get_result(set(), timeout=None)
+        if self.errors:
+            index, error = min(self.errors.items())
+            self.raised.add(index)
+            raise GenerationError(f"Loader {index}: {error}")
+
+    def close(self, commit=True):
+        # Wait for the loaders to load all the batches, and commit their
+        # transactions if all of them succeeded, or roll them all back.
+        if self.closed:
+            return
+        self.closed = True
+
+        ready = set()
+        try:
+            for _ in self.processes:
+                try:
+                    self.ring.put(READY, check=self._check_alive)
+                except GenerationError:
+                    # all the loaders exited
+                    break
+            while len(ready | set(self.errors)) < len(self.processes):
+                self._get_result(ready)
+            self.decision.value = 1 if commit and not self.errors else 0
+        finally:
+            self.decided.set()
+            for process in self.processes:
+                process.join()
+            self.ring.unlink()
+
+        # the errors of the commits
+        done = set()
+        while len(done | set(self.errors)) < len(self.processes):
+            self._get_result(done)
+
+        errors = sorted(
+            (index, error) for index, error in self.errors.items()
+            if index not in self.raised
+        )
+        if errors:
+            raise GenerationError('\n'.join(
+                f"Loader {index}: {error}" for index, error in errors
+            ))
+
+    def _get_result(self, received, timeout=1):
+        # Get the next result of a loader, adding its index to 'received'
+        # or its error to 'errors'. The loaders which exited without
+        # reporting it are failed.
+        try:
+            if timeout is None:
+                index, status, message = self.results.get_nowait()
+            else:
+                index, status, message = self.results.get(timeout=timeout)
+        except queue.Empty:
+            for index, process in enumerate(self.processes):
+                if (index not in received and index not in self.errors and
+                        process.exitcode is not None):
+                    self.errors[index] = (
+                        f"Exited with code {process.exitcode}"
+                    )
+            return
+        if status == 'error':
+            self.errors[index] = message
+        else:
+            received.add(index)
+
+    def _check_alive(self):
+        if all(process.exitcode is not None for process in self.processes):
+            raise GenerationError("All the loaders exited.")
+
+
+class _Rollback(Exception):
+    pass
+
+
+def _run_loader(index, backend_cls, backend_kwargs, ring, results, decided,
+                decision):
+    try:
+        backend = backend_cls(**backend_kwargs)
+        try:
+            with backend.transaction():
+                while True:
+                    message = ring.get()
+                    kind, message = message[:1], message[1:]
+                    if kind == READY:
+                        # all the batches are loaded: commit if all the
+                        # loaders succeeded
+                        results.put((index, 'ready', None))
+                        decided.wait()
+                        if not decision.value:
+                            raise _Rollback()
+                        break
+
+                    header, _, data = message.partition(b'\n')
+                    table, fields = header.decode().split('\t')
+                    backend.load(table, fields.split(','), data)
+        finally:
+            backend.close()
+    except _Rollback:
+        pass
+    except Exception as e:
+        results.put((index, 'error', str(e) or type(e).__name__))
+        return
+    finally:
+        ring.close()
+    results.put((index, 'done', None))
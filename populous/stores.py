@@ -0,0 +1,545 @@
+"""
+The stores holding the values of the global 'store_in' vars.
+
+The keyed stores ('name[$key]: value') hold a store for each key.
+
+The shared stores hold integers (like ids) shared between the workers,
+in shared memory segments (see `SharedStore`).
+
+A store is a sequence filled by the generation, which can become very
+large. The last values appended are kept in a list, because they may
+still be pending (see `Pending`), and the older values are packed in a
+compact storage if they all have the same type (integers, UUIDs or
+strings, interned only when they repeat). Past SPILL_SIZE bytes, the
+packed values are moved to a memory-mapped temporary file.
+"""
+import array
+import mmap
+import struct
+import tempfile
+from collections.abc import Sequence
+from uuid import UUID
+
+from populous.compat import resource_tracker
+from populous.compat import shared_memory
+from populous.exceptions import GenerationError
+
+# the number of values kept in the list of the last values
+KEEP_SIZE = 100000
+# the size (in bytes) of the packed values above which they are moved to
+# a memory-mapped file
+SPILL_SIZE = 64 * 1024 * 1024
+# the ratio of distinct strings above which they are not interned
+MAX_DISTINCT_RATIO = 0.5
+
+# the number of values of each shared memory segment of a shared store
+SHARED_CHUNK_SIZE = 1024 * 1024
+
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+
+
+class IntCodec:
+    struct = struct.Struct('<q')
+
+    def accepts(self, value):
+        return type(value) is int and INT64_MIN <= value <= INT64_MAX
+
+    def encode(self, value):
+        return self.struct.pack(value)
+
+    def decode(self, buffer, offset):
+        return self.struct.unpack_from(buffer, offset)[0]
+
+
+class UUIDCodec:
+    struct = struct.Struct('16s')
+
+    def accepts(self, value):
+        return type(value) is UUID
+
+    def encode(self, value):
+        return value.bytes
+
+    def decode(self, buffer, offset):
+        return UUID(bytes=self.struct.unpack_from(buffer, offset)[0])
+
+
+class StrCodec:
+    # the repeated strings are stored once in a table, and packed as their
+    # index in this table
+    struct = struct.Struct('<I')
+
+    def __init__(self):
+        self.strings = []
+        self.indexes = {}
+
+    def accepts(self, value):
+        return type(value) is str
+
+    def encode(self, value):
+        try:
+            index = self.indexes[value]
+        except KeyError:
+            index = self.indexes[value] = len(self.strings)
+            self.strings.append(value)
+        return self.struct.pack(index)
+
+    def decode(self, buffer, offset):
+        return self.strings[self.struct.unpack_from(buffer, offset)[0]]
+
+
+def get_packed_values(values):
+    # the packed storage able to hold all the values, or None
+    if all(type(value) is str for value in values):
+        if len(set(values)) > len(values) * MAX_DISTINCT_RATIO:
+            return PackedStrings()
+        return PackedValues(StrCodec())
+    for codec in (IntCodec(), UUIDCodec()):
+        if all(codec.accepts(value) for value in values):
+            return PackedValues(codec)
+    return None
+
+
+class PackedBuffer:
+    """
+    Packed values, in a bytearray, or in a memory-mapped temporary file
+    past SPILL_SIZE bytes.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.size = 0
+        self.file = None
+
+    def _write(self, data):
+        # append 'data' to the buffer
+        end = self.size + len(data)
+        if self.file is None:
+            self.buffer += data
+            if end > SPILL_SIZE:
+                self.spill()
+        else:
+            if end > len(self.buffer):
+                self.buffer.resize(max(end, 2 * len(self.buffer)))
+            self.buffer[self.size:end] = data
+        self.size = end
+
+    def spill(self):
+        self.file = tempfile.TemporaryFile(prefix='populous-store-')
+        self.file.write(self.buffer)
+        self.file.flush()
+        self.buffer = mmap.mmap(self.file.fileno(), len(self.buffer))
+
+    def close(self):
+        if self.file is not None:
+            self.buffer.close()
+            self.file.close()
+            self.file = None
+
+
+class PackedValues(PackedBuffer):
+    """
+    Values of the same type, packed with a codec in items of the same size.
+    """
+
+    def __init__(self, codec):
+        super().__init__()
+        self.codec = codec
+        self.itemsize = codec.struct.size
+
+    def __len__(self):
+        return self.size // self.itemsize
+
+    def __getitem__(self, index):
+        return self.codec.decode(self.buffer, index * self.itemsize)
+
+    def __setitem__(self, index, value):
+        offset = index * self.itemsize
+        self.buffer[offset:offset + self.itemsize] = self.codec.encode(value)
+
+    def accepts(self, value):
+        return self.codec.accepts(value)
+
+    def extend(self, values):
+        self._write(b''.join(self.codec.encode(value) for value in values))
+
+    @property
+    def interned(self):
+        # the number of strings in the table of the codec, if any
+        if type(self.codec) is StrCodec:
+            return len(self.codec.strings)
+        return 0
+
+
+class PackedStrings(PackedBuffer):
+    """
+    Strings mostly distinct, packed one after the other in UTF-8 with the
+    offsets of their ends, instead of being interned in a table.
+    """
+    interned = 0
+
+    def __init__(self):
+        super().__init__()
+        self.ends = array.array('Q')
+        # the strings replaced, which may not have the same size
+        self.replaced = {}
+
+    def __len__(self):
+        return len(self.ends)
+
+    def __getitem__(self, index):
+        if index in self.replaced:
+            return self.replaced[index]
+        start = self.ends[index - 1] if index else 0
+        return str(self.buffer[start:self.ends[index]], 'utf-8',
+                   'surrogatepass')
+
+    def __setitem__(self, index, value):
+        self.replaced[index] = value
+
+    def accepts(self, value):
+        return type(value) is str
+
+    def extend(self, values):
+        ends = self.ends
+        end = self.size
+        chunks = []
+        for value in values:
+            data = value.encode('utf-8', 'surrogatepass')
+            chunks.append(data)
+            end += len(data)
+            ends.append(end)
+        self._write(b''.join(chunks))
+
+
+class Pending:
+    """
+    A value stored before its object is written, while its id is not
+    known. It is replaced by the value of its expression once the object
+    is written (see `Item.store_final_values`).
+
+    Until then, the stores give None for this value (like the lists of
+    the objects, which hold None instead of the handle).
+    """
+    __slots__ = ('store', 'index', 'expression')
+
+    def __init__(self, store, index, expression):
+        self.store = store
+        self.index = index
+        self.expression = expression
+
+    def __repr__(self):
+        return '<Pending value>'
+
+    def resolve(self, context):
+        self.store[self.index] = self.expression.evaluate_in(context)
+
+
+class Store(Sequence):
+    """
+    A list-like sequence of values, supporting the operations used on
+    the stores: 'append', 'len', indexing (and thus 'random.choice'),
+    iteration, and the replacement of the last values.
+    """
+
+    def __init__(self, values=()):
+        # the older values, packed once their type is known
+        self.packed = None
+        # False if the values cannot be packed
+        self.packable = True
+        self.values = list(values)
+
+    def __len__(self):
+        packed = len(self.packed) if self.packed is not None else 0
+        return packed + len(self.values)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        index = self._get_index(index)
+        packed = len(self.packed) if self.packed is not None else 0
+        if index < packed:
+            return self.packed[index]
+        value = self.values[index - packed]
+        return None if type(value) is Pending else value
+
+    def __iter__(self):
+        packed = self.packed
+        if packed is not None:
+            for index in range(len(packed)):
+                yield packed[index]
+        for value in self.values:
+            yield None if type(value) is Pending else value
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            indexes = range(*index.indices(len(self)))
+            value = list(value)
+            if len(indexes) != len(value):
+                raise ValueError(
+                    "Cannot replace {} values of a store by {} values."
+                    .format(len(indexes), len(value))
+                )
+            for i, v in zip(indexes, value):
+                self[i] = v
+            return
+
+        index = self._get_index(index)
+        packed = len(self.packed) if self.packed is not None else 0
+        if index >= packed:
+            self.values[index - packed] = value
+        elif self.packed.accepts(value):
+            self.packed[index] = value
+        else:
+            self._unpack()
+            self.values[index] = value
+
+    def __eq__(self, other):
+        if not isinstance(other, (Store, list, tuple)):
+            return NotImplemented
+        return len(self) == len(other) and all(
+            a == b for a, b in zip(self, other)
+        )
+
+    def __repr__(self):
+        return f'<Store of {len(self)} values>'
+
+    def _get_index(self, index):
+        length = len(self)
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError('store index out of range')
+        return index
+
+    def append(self, value):
+        values = self.values
+        values.append(value)
+        if self.packable and len(values) >= 2 * KEEP_SIZE:
+            self._pack(len(values) - KEEP_SIZE)
+
+    def extend(self, values):
+        for value in values:
+            self.append(value)
+
+    def _pack(self, count):
+        # pack the first 'count' values of the list, up to the first value
+        # still pending
+        values = self.values[:count]
+        for i, value in enumerate(values):
+            if type(value) is Pending:
+                count = i
+                values = values[:count]
+                break
+        if not values:
+            return
+        if self.packed is None:
+            self.packed = get_packed_values(values)
+            if self.packed is None:
+                self.packable = False
+                return
+        elif not all(self.packed.accepts(value) for value in values):
+            self._unpack()
+            return
+
+        self.packed.extend(values)
+        del self.values[:count]
+
+        if self.packed.interned > len(self.packed) * MAX_DISTINCT_RATIO:
+            # the strings don't repeat enough to be interned anymore
+            packed = self.packed
+            self.packed = PackedStrings()
+            self.packed.extend(packed[i] for i in range(len(packed)))
+            packed.close()
+
+    def _unpack(self):
+        # the values don't have the same type anymore
+        packed = self.packed
+        self.values[:0] = [packed[i] for i in range(len(packed))]
+        packed.close()
+        self.packed = None
+        self.packable = False
+
+
+class KeyedStore(dict):
+    """
+    The stores of a keyed 'store_in' var, by key. A key without any value
+    gives an empty sequence, so that it can be used like an empty store
+    (e.g. in a 'Choices' generator).
+    """
+
+    def __missing__(self, key):
+        return ()
+
+    def __repr__(self):
+        return f'<KeyedStore of {len(self)} keys>'
+
+    def get_store(self, key):
+        # the store of the key, created if needed
+        store = self.get(key)
+        if store is None:
+            store = self[key] = Store()
+        return store
+
+
+class SharedStore(Sequence):
+    """
+    A store of integers shared between the workers, without copy.
+
+    Each worker appends its values to its own shared memory segments
+    (named '<prefix>_<worker>_<chunk>', of SHARED_CHUNK_SIZE values), once
+    they are not pending anymore, and publishes their number at the start
+    of its first segment with 'publish'.
+
+    The values are published once the transaction of the worker is
+    committed: they are usually ids, which the other workers can only
+    reference once their rows are visible to them (and never rolled back).
+
+    Reading the store gives all the values of this worker, and the values
+    published by the others: the store only grows, so the indexes stay
+    valid.
+    """
+    header = struct.Struct('<q')
+    value = struct.Struct('<q')
+
+    def __init__(self, prefix, worker, workers):
+        self.prefix = prefix
+        self.worker = worker
+        self.workers = workers
+        self.segments = {}
+        # the number of values written in the segments of this worker, and
+        # its values still pending
+        self.written = 0
+        self.values = []
+        self._get_segment(worker, 0)
+
+    def __len__(self):
+        return sum(self._get_length(worker) for worker in range(self.workers))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        if index < 0:
+            index += len(self)
+        if index >= 0:
+            for worker in range(self.workers):
+                length = self._get_length(worker)
+                if index < length:
+                    chunk, index = divmod(index, SHARED_CHUNK_SIZE)
+                    segment = self._get_segment(worker, chunk)
+                    return self.value.unpack_from(
+                        segment.buf,
+                        self.header.size + index * self.value.size
+                    )[0]
+                index -= length
+        raise IndexError('store index out of range')
+
+    def __setitem__(self, index, value):
+        # only the values of this worker not written yet can be set
+        # (see `Pending`)
+        self.values[index - self.written] = value
+        self._write()
+
+    def __repr__(self):
+        return f'<SharedStore of {len(self)} values>'
+
+    def append(self, value):
+        if type(value) is Pending:
+            # the index of the value for this worker
+            value.index = self.written + len(self.values)
+        self.values.append(value)
+        self._write()
+
+    def extend(self, values):
+        for value in values:
+            self.append(value)
+
+    def publish(self):
+        # share the values written with the other workers
+        self.header.pack_into(
+            self._get_segment(self.worker, 0).buf, 0, self.written
+        )
+
+    def close(self):
+        for segment in self.segments.values():
+            segment.close()
+        self.segments = {}
+
+    def _write(self):
+        # write the values up to the first pending one
+        values = self.values
+        count = 0
+        for value in values:
+            if type(value) is Pending:
+                break
+            if type(value) is not int or not INT64_MIN <= value <= INT64_MAX:
+                raise GenerationError(
+                    "The shared store '{}' can only hold integers, got "
+                    "'{!r}'.".format(self.prefix, value)
+                )
+            chunk, index = divmod(self.written + count, SHARED_CHUNK_SIZE)
+            self.value.pack_into(
+                self._get_segment(self.worker, chunk).buf,
+                self.header.size + index * self.value.size,
+                value
+            )
+            count += 1
+
+        if count:
+            del values[:count]
+            self.written += count
+
+    def _get_length(self, worker):
+        if worker == self.worker:
+            return self.written
+        segment = self._get_segment(worker, 0)
+        if segment is None:
+            # the worker did not start yet
+            return 0
+        return self.header.unpack_from(segment.buf, 0)[0]
+
+    def _get_segment(self, worker, chunk):
+        try:
+            return self.segments[worker, chunk]
+        except KeyError:
+            pass
+
+        name = f'{self.prefix}_{worker}_{chunk}'
+        try:
+            if worker == self.worker:
+                segment = shared_memory.SharedMemory(
+                    name, create=True, size=(
+                        self.header.size +
+                        SHARED_CHUNK_SIZE * self.value.size
+                    )
+                )
+            else:
+                segment = shared_memory.SharedMemory(name)
+        except FileNotFoundError:
+            return None
+        # the segments are unlinked by the main process once all the
+        # workers are done (see `unlink_shared_store`), not when the
+        # worker attaching them exits
+        resource_tracker.unregister(segment._name, 'shared_memory')
+
+        self.segments[worker, chunk] = segment
+        return segment
+
+
+def unlink_shared_store(prefix, workers):
+    # remove the segments of a shared store
+    for worker in range(workers):
+        chunk = 0
+        while True:
+            try:
+                segment = shared_memory.SharedMemory(
+                    f'{prefix}_{worker}_{chunk}'
+                )
+            except FileNotFoundError:
+                break
+            segment.close()
+            segment.unlink()
+            chunk += 1
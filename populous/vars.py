@@ -1,7 +1,15 @@
+import keyword
+import random
 import re
+from functools import lru_cache
 from operator import attrgetter
 
 import jinja2
+import jinja2.meta
+from jinja2 import nodes
+from jinja2.parser import Parser
+from jinja2.utils import consume
+from jinja2.visitor import NodeVisitor
 
 from populous.exceptions import GenerationError
 from populous.exceptions import ValidationError
@@ -10,6 +18,16 @@ from populous.jinja import jinja_env
 
 VAR_REGEX = re.compile(r'^[a-zA-Z_][a-zA-Z0-9_]*(\.[a-zA-Z_][a-zA-Z0-9_]*)*$')
 
+# the filters returning a different value at each call
+RANDOM_FILTERS = frozenset(('random',))
+
+# the filters which can be called from the expressions compiled to python
+PYTHON_FILTERS = frozenset((
+    'abs', 'capitalize', 'center', 'count', 'default', 'd', 'float', 'format',
+    'int', 'length', 'lower', 'round', 'string', 'title', 'trim', 'upper',
+    'wordcount',
+))
+
 
 def parse_vars(value):
     if not value or not isinstance(value, str):
@@ -47,9 +65,317 @@ def parse_vars(value):
     return value
 
 
+def _get_path(node):
+    # return the path ('var', 'attr', ...) of a node like 'var.attr[\'x\']',
+    # or None if the node is not a simple attribute access
+    if isinstance(node, nodes.Name):
+        return (node.name,) if node.ctx == 'load' else None
+    if isinstance(node, nodes.Getattr):
+        attr = node.attr
+    elif (isinstance(node, nodes.Getitem) and
+          isinstance(node.arg, nodes.Const) and
+          isinstance(node.arg.value, str)):
+        attr = node.arg.value
+    else:
+        return None
+    path = _get_path(node.node)
+    return path + (attr,) if path else None
+
+
+def find_references(node):
+    path = _get_path(node)
+    if path:
+        yield path
+        return
+    for child in node.iter_child_nodes():
+        yield from find_references(child)
+
+
+def find_attributes(node):
+    # all the attribute names which may be used by the expression: the
+    # attributes accessed, and the strings which could be used as
+    # attribute names (like in 'map(attribute="name")')
+    for child in node.find_all((nodes.Getattr, nodes.Const)):
+        if isinstance(child, nodes.Getattr):
+            yield child.attr
+        elif isinstance(child.value, str):
+            yield child.value
+
+
+def is_deterministic(node):
+    # an expression is deterministic if it does not call any function
+    # (which could be 'fake', 'cycler', ...) nor any random filter
+    if isinstance(node, nodes.Call):
+        return False
+    if isinstance(node, nodes.Filter) and node.name in RANDOM_FILTERS:
+        return False
+    return all(is_deterministic(child) for child in node.iter_child_nodes())
+
+
+def _parse_expression(source):
+    parser = Parser(jinja_env, source, state='variable')
+    try:
+        expression = parser.parse_expression()
+        if not parser.stream.eos:
+            raise jinja2.TemplateSyntaxError(
+                "chunk after expression", parser.stream.current.lineno,
+                None, None
+            )
+        expression.set_environment(jinja_env)
+    except jinja2.TemplateSyntaxError:
+        jinja_env.handle_exception(source=source)
+    return expression
+
+
+def _getattr(obj, attr):
+    # same lookup as jinja for 'obj.attr', but failing instead of
+    # returning an undefined value
+    try:
+        return getattr(obj, attr)
+    except AttributeError:
+        return obj[attr]
+
+
+def _getitem(obj, arg):
+    # same lookup as jinja for 'obj[arg]'
+    try:
+        return obj[arg]
+    except (TypeError, LookupError):
+        if not isinstance(arg, str):
+            raise
+        return getattr(obj, arg)
+
+
+class UnsupportedNode(Exception):
+    pass
+
+
+class PythonCompiler(NodeVisitor):
+    """
+    Translate a jinja expression to the source of an equivalent python
+    expression, using the variable 'context' to get the variables.
+
+    Only the simple expressions are supported (variables and their
+    attributes, literals, arithmetic, comparisons and some filters), and
+    the templates made of text and such expressions: `UnsupportedNode`
+    is raised for anything else.
+    """
+
+    BINARY_OPERATORS = {
+        'Add': '+', 'Sub': '-', 'Mul': '*', 'Div': '/', 'FloorDiv': '//',
+        'Mod': '%', 'Pow': '**', 'And': 'and', 'Or': 'or',
+    }
+    UNARY_OPERATORS = {'Not': 'not ', 'Neg': '-', 'Pos': '+'}
+    COMPARE_OPERATORS = {
+        'eq': '==', 'ne': '!=', 'gt': '>', 'gteq': '>=', 'lt': '<',
+        'lteq': '<=', 'in': 'in', 'notin': 'not in',
+    }
+
+    def __init__(self):
+        # the objects used by the python expression
+        self.namespace = {'getattr_': _getattr, 'getitem_': _getitem}
+
+    def generic_visit(self, node, *args, **kwargs):
+        raise UnsupportedNode(type(node).__name__)
+
+    def visit_Name(self, node):
+        if node.ctx != 'load':
+            self.generic_visit(node)
+        return f'context[{node.name!r}]'
+
+    def visit_Getattr(self, node):
+        if keyword.iskeyword(node.attr):
+            self.generic_visit(node)
+        if isinstance(node.node, nodes.Name) and node.node.name == 'this':
+            # the object being generated is never a mapping, get its
+            # attributes directly (falling back to jinja if 'this' is
+            # not set)
+            return f'context.this.{node.attr}'
+        return f'getattr_({self.visit(node.node)}, {node.attr!r})'
+
+    def visit_Getitem(self, node):
+        if isinstance(node.arg, nodes.Slice):
+            self.generic_visit(node.arg)
+        return f'getitem_({self.visit(node.node)}, {self.visit(node.arg)})'
+
+    def visit_Const(self, node):
+        def _is_literal(value):
+            if isinstance(value, tuple):
+                return all(_is_literal(v) for v in value)
+            return isinstance(value, (str, int, float, bool, type(None)))
+
+        if not _is_literal(node.value):
+            self.generic_visit(node)
+        return repr(node.value)
+
+    def visit_Tuple(self, node):
+        return '({}{})'.format(
+            ', '.join(self.visit(item) for item in node.items),
+            ',' if len(node.items) == 1 else ''
+        )
+
+    def visit_List(self, node):
+        return '[{}]'.format(', '.join(self.visit(i) for i in node.items))
+
+    def visit_Concat(self, node):
+        return "''.join(({},))".format(
+            ', '.join(f'str({self.visit(n)})' for n in node.nodes)
+        )
+
+    def visit_BinExpr(self, node):
+        operator = self.BINARY_OPERATORS[type(node).__name__]
+        return (f'({self.visit(node.left)} {operator} '
+                f'{self.visit(node.right)})')
+
+    def visit_UnaryExpr(self, node):
+        operator = self.UNARY_OPERATORS[type(node).__name__]
+        return f'({operator}{self.visit(node.node)})'
+
+    def visit_Compare(self, node):
+        source = self.visit(node.expr)
+        for operand in node.ops:
+            operator = self.COMPARE_OPERATORS[operand.op]
+            source += f' {operator} {self.visit(operand.expr)}'
+        return f'({source})'
+
+    def visit_CondExpr(self, node):
+        if node.expr2 is None:
+            # jinja returns an undefined value
+            self.generic_visit(node)
+        return (f'({self.visit(node.expr1)} if {self.visit(node.test)} '
+                f'else {self.visit(node.expr2)})')
+
+    def visit_Filter(self, node):
+        if (node.name not in PYTHON_FILTERS or node.dyn_args or
+                node.dyn_kwargs or node.node is None):
+            self.generic_visit(node)
+        function = jinja_env.filters[node.name]
+        if getattr(function, 'jinja_pass_arg', None):
+            # the filter needs the jinja context or environment
+            self.generic_visit(node)
+
+        name = f'filter_{node.name}'
+        self.namespace[name] = function
+        args = [self.visit(node.node)]
+        args += [self.visit(arg) for arg in node.args]
+        args += [f'{kwarg.key}={self.visit(kwarg.value)}'
+                 for kwarg in node.kwargs]
+        return '{}({})'.format(name, ', '.join(args))
+
+    def visit_Template(self, node):
+        # templates made only of text and '{{ expression }}'
+        parts = []
+        for child in node.body:
+            if not isinstance(child, nodes.Output):
+                self.generic_visit(child)
+            for part in child.nodes:
+                if isinstance(part, nodes.TemplateData):
+                    parts.append(repr(part.data))
+                else:
+                    parts.append(f'str({self.visit(part)})')
+        return "''.join(({}))".format(''.join(f'{p}, ' for p in parts))
+
+
+# the jinja nodes of each kind of operator
+for _name in PythonCompiler.BINARY_OPERATORS:
+    setattr(PythonCompiler, f'visit_{_name}', PythonCompiler.visit_BinExpr)
+for _name in PythonCompiler.UNARY_OPERATORS:
+    setattr(PythonCompiler, f'visit_{_name}', PythonCompiler.visit_UnaryExpr)
+
+
+def compile_python(expression, name='<expression>'):
+    # Return a python function evaluating the jinja expression in
+    # a context, or None if the expression is not supported.
+    compiler = PythonCompiler()
+    try:
+        source = compiler.visit(expression)
+    except UnsupportedNode:
+        return None
+    return eval(compile(f'lambda context: {source}', name, 'eval'),
+                compiler.namespace)
+
+
+@lru_cache(maxsize=None)
+def compile_value_expression(source):
+    # The same expressions are used in many fields and items, they are
+    # compiled only once.
+    # Same as Environment.compile_expression, but we need the template
+    # itself to render it with our own context.
+    expression = _parse_expression(source)
+    body = [nodes.Assign(nodes.Name('result', 'store'), expression,
+                         lineno=1)]
+    template = jinja_env.from_string(nodes.Template(body, lineno=1))
+    function = compile_python(expression, f'$({source})')
+    return expression, template, function
+
+
+@lru_cache(maxsize=None)
+def compile_template(source):
+    # the templates made only of text and expressions (like
+    # '{{ this.first }}.{{ this.last }}@example.com') are concatenated
+    # by a python function
+    ast = jinja_env.parse(source)
+    template = jinja_env.from_string(ast)
+    function = compile_python(ast, source)
+    return ast, template, function
+
+
+class Context:
+    """
+    The variables available to the expressions.
+
+    The context is given by reference to the expressions, so that the
+    variables are never copied. The object being generated is stored in
+    the 'this' slot, and the random generator used by the 'random' filter
+    (the one of the field being generated) in the 'random' slot.
+    """
+    __slots__ = ('vars', 'this', 'random')
+
+    def __init__(self, vars_, this=None):
+        self.vars = vars_
+        self.this = this
+        self.random = random
+
+    def __getitem__(self, name):
+        if name == 'this' and self.this is not None:
+            return self.this
+        try:
+            return self.vars[name]
+        except KeyError:
+            # the jinja globals ('range', 'dict', ...)
+            return jinja_env.globals[name]
+
+    def __contains__(self, name):
+        return (
+            (name == 'this' and self.this is not None) or
+            name in self.vars or name in jinja_env.globals
+        )
+
+
 class Expression:
 
-    def evaluate(self, **vars):
+    # the paths of the variables (and of their attributes) used by this
+    # expression. A path of only one element means that the variable is
+    # used as a whole.
+    references = frozenset()
+
+    # the names of all the attributes this expression may use, on any
+    # object
+    attributes = frozenset()
+
+    # does the expression always give the same result for the same
+    # variables?
+    deterministic = True
+
+    @property
+    def variables(self):
+        # the names of the variables this expression depends on
+        return frozenset(path[0] for path in self.references)
+
+    def evaluate(self, **vars_):
+        return self.evaluate_in(Context(vars_))
+
+    def evaluate_in(self, context):
         raise NotImplementedError()
 
 
@@ -63,10 +389,12 @@ class ValueExpression(Expression):
         else:
             self.attrgetter = None
         self.attrs = attrs
+        self.references = frozenset((tuple(value.split('.')),))
+        self.attributes = frozenset(value.split('.')[1:])
 
-    def evaluate(self, **vars_):
+    def evaluate_in(self, context):
         try:
-            var = vars_[self.var]
+            var = context[self.var]
         except KeyError:
             raise GenerationError(
                 "Error generating value '${}': '{}' is undefined"
@@ -92,8 +420,8 @@ class JinjaValueExpression(Expression):
     def __init__(self, value):
         self.value = value
         try:
-            self.expression = jinja_env.compile_expression(
-                value, undefined_to_none=False
+            expression, self.template, self.function = (
+                compile_value_expression(value)
             )
         except jinja2.TemplateError as e:
             raise ValidationError(
@@ -101,9 +429,24 @@ class JinjaValueExpression(Expression):
                 .format(value, e)
             )
 
-    def evaluate(self, **vars_):
+        self.references = frozenset(find_references(expression))
+        self.attributes = frozenset(find_attributes(expression))
+        self.deterministic = is_deterministic(expression)
+
+    def evaluate_in(self, context):
+        if self.function is not None:
+            try:
+                return self.function(context)
+            except Exception:
+                # let jinja evaluate the expression, to get the same
+                # result or error
+                pass
+
+        template = self.template
         try:
-            value = self.expression(vars_)
+            ctx = template.new_context(context, shared=True)
+            consume(template.root_render_func(ctx))
+            value = ctx.vars['result']
             if isinstance(value, jinja2.Undefined):
                 # trigger a UndefinedError
                 str(value)
@@ -119,16 +462,33 @@ class TemplateExpression(Expression):
     def __init__(self, value=""):
         self.value = value
         try:
-            self.template = jinja_env.from_string(value)
+            ast, self.template, self.function = compile_template(value)
         except jinja2.TemplateError as e:
             raise ValidationError(
                 "Error parsing template '{}': {}"
                 .format(value, e)
             )
+        # ignore the variables defined in the template itself
+        variables = jinja2.meta.find_undeclared_variables(ast)
+        self.references = frozenset(
+            path for path in find_references(ast) if path[0] in variables
+        )
+        self.attributes = frozenset(find_attributes(ast))
+        self.deterministic = is_deterministic(ast)
 
-    def evaluate(self, **vars_):
+    def evaluate_in(self, context):
+        if self.function is not None:
+            try:
+                return self.function(context)
+            except Exception:
+                # let jinja render the template, to get the same
+                # result or error
+                pass
+
+        template = self.template
         try:
-            return self.template.render(vars_)
+            ctx = template.new_context(context, shared=True)
+            return ''.join(template.root_render_func(ctx))
         except jinja2.UndefinedError as e:
             raise GenerationError(
                 f"Error generating template '{self.value}': {e}"
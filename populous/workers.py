@@ -0,0 +1,178 @@
+"""
+Generation in several processes.
+
+The objects of the items without a 'count by' (the roots of the
+generation) are shared between the workers, each worker generating the
+objects of its share and their dependencies. The workers share nothing:
+each one loads the blueprint, and has its own backend connection, random
+state, buffer and stores.
+
+The logs of the workers are forwarded to the logger of the main process,
+and their errors are collected by the main process once all the workers
+are done.
+"""
+import logging
+import logging.handlers
+import multiprocessing
+import queue
+
+from populous.exceptions import GenerationError
+
+logger = logging.getLogger('populous')
+
+# the commit modes: each worker commits its transaction when it is done,
+# or the workers only commit once all of them are done without error
+PER_WORKER = 'per-worker'
+ATOMIC = 'atomic'
+COMMIT_MODES = (PER_WORKER, ATOMIC)
+
+
+class Rollback(Exception):
+    """
+    Raised in a worker to roll back its transaction, when another worker
+    failed in the atomic mode.
+    """
+
+
+def split_counts(counts, workers):
+    """
+    Share the rows of each item between the workers:
+
+        >>> split_counts({'foo': 5, 'bar': 1}, 2)
+        [{'foo': range(0, 3), 'bar': range(0, 1)},
+         {'foo': range(3, 5), 'bar': range(1, 1)}]
+    """
+    shares = [{} for _ in range(workers)]
+    for name, count in counts.items():
+        quotient, remainder = divmod(count, workers)
+        start = 0
+        for index, share in enumerate(shares):
+            stop = start + quotient + (1 if index < remainder else 0)
+            share[name] = range(start, stop)
+            start = stop
+    return shares
+
+
+def run_workers(target, args, counts, workers, commit=PER_WORKER):
+    """
+    Run 'target(*args, counts=..., ready=..., worker=..., workers=...)'
+    in 'workers' processes, each one with its share of 'counts' and its
+    index.
+
+    The target must call 'ready()' when its objects are generated, before
+    committing its transaction, and roll it back if it returns False.
+    """
+    # the workers are started from a fresh interpreter, so that they
+    # don't share the random state nor the connections of this process
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    logs = context.Queue()
+    decided = context.Event()
+    decision = context.Value('b', 0)
+
+    listener = logging.handlers.QueueListener(logs, _LogForwarder())
+    listener.start()
+
+    processes = [
+        context.Process(
+            target=_run_worker,
+            args=(index, workers, target, args, share, commit == ATOMIC,
+                  results, decided, decision, logs,
+                  logger.getEffectiveLevel()),
+            name=f'populous-worker-{index}',
+        )
+        for index, share in enumerate(split_counts(counts, workers))
+    ]
+    for process in processes:
+        process.start()
+
+    errors = {}
+    ready = set()
+    done = set()
+    try:
+        while len(done | set(errors)) < workers:
+            if (commit == ATOMIC and not decided.is_set() and
+                    len(ready | set(errors)) == workers):
+                # all the workers are ready or failed: commit all the
+                # transactions or none
+                decision.value = 0 if errors else 1
+                decided.set()
+
+            try:
+                index, status, message = results.get(timeout=1)
+            except queue.Empty:
+                _check_processes(processes, done, errors)
+                continue
+
+            if status == 'ready':
+                ready.add(index)
+            elif status == 'done':
+                done.add(index)
+            else:
+                errors[index] = message
+    finally:
+        # don't let a worker wait forever for the decision
+        decided.set()
+        for process in processes:
+            process.join()
+        listener.stop()
+
+    if errors:
+        raise GenerationError('\n'.join(
+            f"Worker {index}: {message}"
+            for index, message in sorted(errors.items())
+        ))
+
+
+def _check_processes(processes, done, errors):
+    # the workers which died without reporting it (killed...)
+    for index, process in enumerate(processes):
+        if (index not in done and index not in errors and
+                process.exitcode is not None):
+            errors[index] = f"Exited with code {process.exitcode}"
+
+
+class _LogForwarder(logging.Handler):
+    # emit the records of the workers with the logger of this process
+
+    def emit(self, record):
+        logger.handle(record)
+
+
+class _WorkerFilter(logging.Filter):
+    # prefix the messages of a worker with its index
+
+    def __init__(self, index):
+        super().__init__()
+        self.index = index
+
+    def filter(self, record):
+        record.msg = f"[worker {self.index}] {record.getMessage()}"
+        record.args = None
+        return True
+
+
+def _run_worker(index, workers, target, args, counts, atomic, results,
+                decided, decision, logs, level):
+    handler = logging.handlers.QueueHandler(logs)
+    handler.addFilter(_WorkerFilter(index))
+    logger.handlers = [handler]
+    logger.setLevel(level)
+    logger.propagate = False
+
+    def ready():
+        if not atomic:
+            return True
+        results.put((index, 'ready', None))
+        decided.wait()
+        return decision.value == 1
+
+    try:
+        target(*args, counts=counts, ready=ready, worker=index,
+               workers=workers)
+    except Rollback:
+        logger.info("Transaction rolled back.")
+    except Exception as e:
+        results.put((index, 'error', str(e) or type(e).__name__))
+        return
+    results.put((index, 'done', None))
@@ -33,6 +33,7 @@ setup(
     install_requires=requirements,
     extras_require={
         'tests': ['tox', 'pytest', 'pytest-mock', 'flake8', 'isort', 'black'],
+        'numpy': ['numpy'],
     },
     entry_points={
         'console_scripts': [
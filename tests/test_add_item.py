@@ -3,6 +3,7 @@ import pytest
 from populous import generators
 from populous.blueprint import Blueprint
 from populous.exceptions import ValidationError
+from populous.stores import KeyedStore
 from populous.vars import ValueExpression
 
 
@@ -53,7 +54,7 @@ def test_with_extra_keys():
     blueprint = Blueprint()
 
     msg = ("Unknown key(s) 'foo'. Possible keys are 'name, parent, "
-           "table, count, fields, store_in'.")
+           "table, count, fields, store_in, batch_size'.")
     with pytest.raises(ValidationError) as e:
         blueprint.add_item({'name': 'foo', 'table': 'bar', 'foo': 'bar'})
     assert msg in str(e.value)
@@ -115,6 +116,29 @@ def test_parent_without_name():
     assert blueprint.items['foo'].table == 'test'
 
 
+def test_batch_size():
+    blueprint = Blueprint()
+
+    blueprint.add_item({'name': 'foo', 'table': 'test'})
+    assert blueprint.items['foo'].batch_size is None
+
+    blueprint.add_item({'name': 'foo', 'batch_size': 50})
+    assert blueprint.items['foo'].batch_size == 50
+
+    blueprint.add_item({'name': 'bar', 'parent': 'foo'})
+    assert blueprint.items['bar'].batch_size == 50
+
+    blueprint.add_item({'name': 'bar', 'batch_size': 'auto'})
+    assert blueprint.items['bar'].batch_size == 'auto'
+
+    for value in (0, -1, 'foo', 1.5, True):
+        msg = ("Item 'foo': The batch size must be a positive integer or "
+               "'auto' (got: '{}').".format(value))
+        with pytest.raises(ValidationError) as e:
+            blueprint.add_item({'name': 'foo', 'batch_size': value})
+        assert msg in str(e.value)
+
+
 def test_store_in_not_dict():
     blueprint = Blueprint()
 
@@ -173,6 +197,36 @@ def test_store_in_non_existing_item():
     assert msg in str(e.value)
 
 
+def test_store_in_keyed():
+    blueprint = Blueprint()
+
+    blueprint.add_item({'name': 'foo', 'table': 'bar',
+                        'store_in': {
+                            'foos_by_kind[$this.kind]': '$this',
+                            'foo_ids_by_kind[$(this.kind|upper)]': '$this.id',
+                        }})
+    foo = blueprint.items['foo']
+
+    assert set(foo.store_in_global) == {'foos_by_kind', 'foo_ids_by_kind'}
+    assert foo.store_in_keys['foos_by_kind'].value == 'this.kind'
+    assert isinstance(blueprint.vars['foos_by_kind'], KeyedStore)
+    assert blueprint.vars['foos_by_kind']['unknown'] == ()
+
+    msg = ("Error in 'store_in' section in item 'lol': The store "
+           "'foos_by_kind' is used both with and without a key.")
+    with pytest.raises(ValidationError) as e:
+        blueprint.add_item({'name': 'lol', 'table': 'lol',
+                            'store_in': {'foos_by_kind': '$this'}})
+    assert msg in str(e.value)
+
+    msg = ("Error in 'store_in' section in item 'lol': The key of the "
+           "store 'lols' cannot use the id of the object.")
+    with pytest.raises(ValidationError) as e:
+        blueprint.add_item({'name': 'lol', 'table': 'lol',
+                            'store_in': {'lols[$this.id]': '$this'}})
+    assert msg in str(e.value)
+
+
 def test_inherit_store_in():
     blueprint = Blueprint()
 
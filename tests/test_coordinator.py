@@ -0,0 +1,124 @@
+import functools
+import json
+import multiprocessing
+import os
+from datetime import datetime
+
+import pytest
+
+from populous.coordinator import RUNNING
+from populous.coordinator import WorkDirectory
+from populous.coordinator import _check_abandoned
+from populous.coordinator import run_coordinator
+from populous.coordinator import run_node
+from populous.exceptions import GenerationError
+from populous.workers import Rollback
+
+
+def _target(path, counts=None, ready=None, worker=None, workers=None,
+            partition=None, seed=None, random_access=False, now=None):
+    # a target writing the rows of its unit in a file once committed, and
+    # failing once (or always) or dying when asked to with a file
+    directory = os.path.dirname(path)
+    for action in ('fail', 'die', 'always-fail'):
+        marker = os.path.join(directory, f'{action}-{worker}')
+        if not os.path.exists(marker):
+            continue
+        if action == 'always-fail':
+            raise ValueError(f"Cannot generate the unit {worker}")
+        os.unlink(marker)
+        if action == 'die':
+            os._exit(1)
+        raise ValueError(f"Cannot generate the unit {worker} once")
+
+    if not ready():
+        raise Rollback()
+    with open(path, 'a') as f:
+        f.write(json.dumps({'foo': list(counts['foo']), 'workers': workers,
+                            'partition': partition, 'seed': seed,
+                            'now': now.isoformat()}) + '\n')
+
+
+def _run_nodes(tmp_path, nodes, slots=None, **kwargs):
+    directory = str(tmp_path / 'work')
+    path = str(tmp_path / 'rows')
+    context = multiprocessing.get_context('spawn')
+    processes = [
+        context.Process(
+            target=run_node,
+            args=(directory, functools.partial(_target, path), 0.05),
+        )
+        for _ in range(nodes)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        run_coordinator(directory, {'foo': 10}, 4, slots=slots, seed='foo',
+                        now=datetime(2020, 1, 1), poll=0.05, **kwargs)
+    finally:
+        for process in processes:
+            process.join()
+
+    lines = [json.loads(line) for line in open(path).read().splitlines()]
+    assert all(line['workers'] == 4 and line['seed'] == 'foo' and
+               line['now'] == '2020-01-01T00:00:00' for line in lines)
+    # the unique values are shared between the slots of the nodes
+    assert all(line['partition'][1] == (slots or 4) and
+               line['partition'][0] < (slots or 4) for line in lines)
+    return sorted(row for line in lines for row in line['foo'])
+
+
+def test_run_coordinator(tmp_path):
+    assert _run_nodes(tmp_path, 2, slots=2) == list(range(10))
+
+    # a directory is only used once
+    with pytest.raises(GenerationError):
+        run_coordinator(str(tmp_path / 'work'), {'foo': 10}, 4)
+
+
+def test_run_coordinator_retries(tmp_path):
+    # a unit fails once and the node generating another one dies: they
+    # are generated again, by the remaining node, which gets the slot of
+    # the dead node back
+    (tmp_path / 'fail-1').touch()
+    (tmp_path / 'die-2').touch()
+    rows = _run_nodes(tmp_path, 2, slots=1, timeout=1)
+    assert rows == list(range(10))
+
+
+def test_run_coordinator_errors(tmp_path):
+    (tmp_path / 'always-fail-1').touch()
+    with pytest.raises(GenerationError) as e:
+        _run_nodes(tmp_path, 2, retries=1)
+    assert str(e.value) == "Unit 1: Cannot generate the unit 1"
+
+    # the other units are committed
+    lines = (tmp_path / 'rows').read_text().splitlines()
+    assert len(lines) == 3
+
+
+def test_check_abandoned(tmp_path, mocker):
+    work = WorkDirectory(str(tmp_path))
+    work.create({'foo': 2}, 2)
+    first, second = work.claim(), work.claim()
+    monotonic = mocker.patch('populous.coordinator.time.monotonic')
+    heartbeats = {}
+    errors = {}
+
+    def check(now):
+        monotonic.return_value = now
+        _check_abandoned(work, 60, heartbeats, errors)
+        return work.units(RUNNING)
+
+    # the heartbeats are judged by their changes on the clock of the
+    # coordinator, whatever the times of the files
+    work.beat(first, 0)
+    work.beat(second, 0)
+    os.utime(work.heartbeat_path(0), (0, 0))
+    os.utime(work.heartbeat_path(1), (2 ** 32, 2 ** 32))
+    assert check(1000) == [0, 1]
+    work.beat(first, 1)
+    assert check(1050) == [0, 1]
+    assert check(1070) == [0]
+    assert errors == {}
+    assert work.read_error(1, 0) == "No news from the node for 60 seconds."
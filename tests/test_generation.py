@@ -1,9 +1,13 @@
 from datetime import date
 from itertools import count
 
+import pytest
+
+from populous import generators
 from populous.backends.base import Backend
 from populous.blueprint import Blueprint
 from populous.buffer import Buffer
+from populous.exceptions import ValidationError
 from populous.factory import ItemFactory
 from populous.item import Item
 
@@ -39,7 +43,9 @@ def test_item_preprocess(mocker):
             for row in existing:
                 yield tuple(row[columns.index(field)] for field in fields)
 
-    blueprint = Blueprint(backend=mocker.Mock(wraps=DummyBackend()))
+    blueprint = Blueprint(
+        backend=mocker.Mock(wraps=DummyBackend(), columnar=False)
+    )
     item = Item(blueprint, 'person', 'test')
 
     item.add_field('id', 'Integer', unique=True)
@@ -92,7 +98,9 @@ def test_item_preprocess_two_tables(mocker):
             else:
                 return ['1', '2', '3']
 
-    blueprint = Blueprint(backend=mocker.Mock(wraps=DummyBackend()))
+    blueprint = Blueprint(
+        backend=mocker.Mock(wraps=DummyBackend(), columnar=False)
+    )
 
     foo = Item(blueprint, 'foo', 'test1')
     foo.add_field('code', 'Text', unique=True)
@@ -152,6 +160,16 @@ def test_blueprint_generate(mocker):
     assert lol.generate.call_args == mocker.call(buffer, 20)
     assert buffer.flush.called is True
 
+    counts = blueprint.get_root_counts()
+    assert set(counts) == {'foo', 'lol'}
+    assert counts['foo'] == 10
+    assert 10 <= counts['lol'] <= 20
+
+    # generate a share of the objects
+    blueprint.generate(counts={'foo': 3, 'lol': 2})
+    assert foo.generate.call_args == mocker.call(buffer, 3)
+    assert lol.generate.call_args == mocker.call(buffer, 2)
+
 
 def test_item_generate():
     blueprint = Blueprint()
@@ -173,23 +191,180 @@ def test_item_generate():
         assert isinstance(obj.b, int)
 
 
+def test_item_generate_batches(mocker):
+    blueprint = Blueprint()
+
+    blueprint.add_item({'name': 'foo', 'table': 'test',
+                        'fields': {
+                            'a': {'generator': 'Integer'},
+                            'b': '$(this.a + 1)',
+                        }})
+    item = blueprint.items['foo']
+    assert list(item.batched_fields) == ['a']
+
+    a = item.fields['a']
+    mocker.patch.object(a, 'get_batch', wraps=a.get_batch)
+
+    buffer = Buffer(blueprint, maxlen=4)
+    mocker.patch.object(buffer, 'write')
+    item.generate(buffer, 10)
+
+    assert a.get_batch.call_args_list == [
+        mocker.call(4), mocker.call(4), mocker.call(2)
+    ]
+    for obj in buffer.buffers['foo']:
+        assert obj.b == obj.a + 1
+
+
 def test_item_generate_this_var(mocker):
     blueprint = Blueprint()
-    blueprint.add_item({'name': 'foo', 'table': 'test'})
+    blueprint.add_item({'name': 'foo', 'table': 'test',
+                        'fields': {'a': '$this.id'}})
     item = blueprint.items['foo']
 
-    call_count = {'count': 0}
+    objs = []
 
-    def _generate(self):
-        call_count['count'] += 1
-        assert self.blueprint.vars['this'] == self
-        return item.namedtuple(id=1)
+    def _next():
+        this = blueprint.context.this
+        assert isinstance(this, item.object_class)
+        objs.append(this)
+        return 42
 
-    mocker.patch.object(ItemFactory, 'generate', _generate)
+    mocker.patch.object(item.fields['a'], '__next__', _next)
     buffer = Buffer(blueprint)
     item.generate(buffer, 10)
 
-    assert call_count['count'] == 10
+    # a new object is used for each generation
+    assert len({id(obj) for obj in objs}) == 10
+    assert blueprint.context.this is None
+
+
+def test_item_ordered_fields():
+    blueprint = Blueprint()
+    blueprint.add_item({'name': 'foo', 'table': 'test'})
+    blueprint.add_item({'name': 'bar', 'table': 'test',
+                        'count': {'number': 1, 'by': 'foo'},
+                        'fields': {
+                            'email': '{{ this.first }}.{{ this.last }}@x',
+                            'all': '$(this|string)',
+                            'first': {'generator': 'Text',
+                                      'unique': 'last'},
+                            'foo_id': '$this.foo.id',
+                            'last': '$(this.upper|lower)',
+                            'upper': {'generator': 'Text'},
+                        }})
+    item = blueprint.items['bar']
+
+    assert item.ordered_fields == (
+        ['id', 'upper', 'last', 'first', 'email', 'foo_id'], ['all']
+    )
+
+    item.fields['id'] = generators.Value(item, 'id', value=0)
+    parent = blueprint.items['foo'].object_class(id=1)
+    factory = ItemFactory(item, parent=parent)
+    obj = factory.generate()
+    assert obj.email == f'{obj.first}.{obj.last}@x'
+    assert obj.last == obj.upper.lower()
+    assert obj.all.startswith('bar(id=0, ')
+    assert obj.foo == parent
+    assert obj.foo_id == 1
+
+
+def test_item_circular_fields():
+    blueprint = Blueprint()
+
+    # the circular references are detected when the item is added
+    msg = ("Item 'foo': Circular reference between the fields 'a', 'b', "
+           "'c'.")
+    with pytest.raises(ValidationError) as e:
+        blueprint.add_item({'name': 'foo', 'table': 'test',
+                            'fields': {
+                                'a': '$this.b',
+                                'b': '$(this.c + 1)',
+                                'c': '{{ this.a }}',
+                            }})
+    assert msg in str(e.value)
+    assert 'foo' not in blueprint.items
+
+
+def test_item_constant_fields(mocker):
+    blueprint = Blueprint()
+    blueprint.add_var('prefix', 'foo')
+    blueprint.add_item({'name': 'foo', 'table': 'test'})
+    blueprint.add_item({'name': 'bar', 'table': 'test',
+                        'count': {'number': 1, 'by': 'foo'},
+                        'fields': {
+                            'kind': 'bar',
+                            'label': '{{ prefix|upper }}-{{ 40 + 2 }}',
+                            'none': None,
+                            'rand': '$([1, 2]|random)',
+                            'call': '$(range(2)|list)',
+                            'this': '$(this.kind)',
+                            'parent': '$(this.foo.id)',
+                            'nullable': {'generator': 'Value',
+                                         'value': 1, 'nullable': True},
+                        }})
+    item = blueprint.items['bar']
+
+    assert item.constant_fields == {
+        'id': None, 'kind': 'bar', 'label': 'FOO-42', 'none': None,
+    }
+    assert 'kind' not in item.batched_fields
+    assert item.generated_fields == [
+        'rand', 'call', 'this', 'parent', 'nullable'
+    ]
+
+    label = item.fields['label']
+    mocker.patch.object(label, 'evaluate', wraps=label.evaluate)
+
+    parent = blueprint.items['foo'].object_class(id=1)
+    factory = ItemFactory(item, parent=parent)
+    for _ in range(3):
+        obj = factory.generate()
+        assert obj.kind == obj.this == 'bar'
+        assert obj.label == 'FOO-42'
+        assert obj.parent == 1
+
+    # the constant values are inlined
+    assert label.evaluate.called is False
+    assert item.db_values(obj)[:4] == ('bar', 'FOO-42', None, obj.rand)
+
+
+def test_item_on_demand_fields(mocker):
+    class DummyBackend(Backend):
+        def write(self, item, objs):
+            return range(len(objs))
+
+    blueprint = Blueprint(backend=DummyBackend())
+    blueprint.add_item({'name': 'foo', 'table': 'test',
+                        'fields': {
+                            'a': {'generator': 'Integer', 'shadow': True},
+                            'b': {'generator': 'Integer', 'shadow': True},
+                            'c': {'generator': 'Text', 'shadow': True},
+                            'd': '$(this.c|upper)',
+                        }})
+    blueprint.add_item({'name': 'bar', 'table': 'test',
+                        'count': {'number': 1, 'by': 'foo'},
+                        'fields': {'a': '$this.foo.a'}})
+    foo = blueprint.items['foo']
+    assert foo.on_demand_fields == ['a', 'b', 'c']
+    assert foo.used_on_demand_fields == ['a', 'c']
+    assert foo.generated_fields == ['d']
+
+    for name in ('a', 'b'):
+        field = foo.fields[name]
+        mocker.patch.object(field, '__next__', wraps=field.__next__)
+
+    buffer = Buffer(blueprint)
+    foo.generate(buffer, 2)
+    objs = list(buffer.buffers['foo'])
+    assert [obj.d for obj in objs] == [obj.c.upper() for obj in objs]
+    assert foo.fields['a'].__next__.call_count == 0
+
+    # the fields are generated when they are used
+    buffer.flush()
+    assert foo.fields['a'].__next__.call_count == 2
+    assert foo.fields['b'].__next__.call_count == 0
 
 
 def test_write_buffer(mocker):
@@ -202,17 +377,176 @@ def test_write_buffer(mocker):
     item = blueprint.items['foo']
 
     mocker.patch.object(item, 'store_final_values')
-    mocker.patch.object(item, 'generate_dependencies')
+    mocker.patch.object(item, 'generate_dependencies',
+                        return_value=iter(()))
 
     buffer = Buffer(blueprint, maxlen=10)
     item.generate(buffer, 10)
 
-    objs = tuple(item.namedtuple(id=x, a=42) for x in range(10))
     assert len(buffer.buffers['foo']) == 0
-    assert item.store_final_values.call_args == mocker.call(objs)
+    # the ids have been set on the objects written
+    objs, = item.store_final_values.call_args[0]
+    assert [(obj.id, obj.a) for obj in objs] == [(x, 42) for x in range(10)]
     assert item.generate_dependencies.call_args == mocker.call(buffer, objs)
 
 
+def test_write_buffer_objects(mocker):
+    class DummyBackend(Backend):
+        def write(self, item, objs):
+            return range(10, 10 + len(objs))
+
+    blueprint = Blueprint(backend=DummyBackend())
+    blueprint.add_item({'name': 'foo', 'table': 'test', 'fields': {'a': 42},
+                        'store_in': {'foos': '$this'}})
+    item = blueprint.items['foo']
+
+    buffer = Buffer(blueprint)
+    item.generate(buffer, 2)
+    objs = list(buffer.buffers['foo'])
+    assert repr(objs[0]) == 'foo(id=None, a=42)'
+
+    buffer.write(item)
+    # the ids are set on the objects themselves
+    assert blueprint.vars['foos'] == objs
+    assert [obj.id for obj in objs] == [10, 11]
+    assert repr(objs[0]) == 'foo(id=10, a=42)'
+
+    with pytest.raises(AttributeError):
+        objs[0].b
+
+
+def test_write_buffer_columns(mocker):
+    class DummyBackend(Backend):
+        columnar = True
+
+        def write_columns(self, item, columns, size):
+            return range(size)
+
+    blueprint = Blueprint(
+        backend=mocker.Mock(wraps=DummyBackend(), columnar=True)
+    )
+    blueprint.add_item({'name': 'foo', 'table': 'test',
+                        'fields': {'a': 42, 'b': '$(this.a + 1)',
+                                   'c': {'generator': 'Integer',
+                                         'shadow': True}}})
+    blueprint.add_item({'name': 'bar', 'table': 'test'})
+    item = blueprint.items['foo']
+
+    buffer = Buffer(blueprint, maxlen=3)
+    item.generate(buffer, 4)
+    blueprint.items['bar'].generate(buffer, 2)
+    buffer.flush()
+
+    assert blueprint.backend.write.called is False
+    assert blueprint.backend.write_columns.call_args_list == [
+        mocker.call(item, ([42, 42, 42], [43, 43, 43]), 3),
+        mocker.call(item, ([42], [43]), 1),
+        mocker.call(blueprint.items['bar'], (), 2),
+    ]
+
+    # by default, the columns are written as rows
+    backend = Backend()
+    mocker.patch.object(backend, 'write')
+    backend.write_columns(item, ([42, 42], [43, 44]), 2)
+    assert backend.write.call_args == mocker.call(item, ((42, 43), (42, 44)))
+    backend.write_columns(blueprint.items['bar'], (), 2)
+    assert backend.write.call_args == mocker.call(
+        blueprint.items['bar'], ((), ())
+    )
+
+
+def test_write_buffer_batch_sizes(mocker):
+    class DummyBackend(Backend):
+        def write(self, item, objs):
+            return range(len(objs))
+
+    blueprint = Blueprint(
+        backend=mocker.Mock(wraps=DummyBackend(), columnar=False)
+    )
+    blueprint.add_item({'name': 'foo', 'table': 'test', 'batch_size': 2})
+    blueprint.add_item({'name': 'bar', 'table': 'test'})
+    blueprint.add_item({'name': 'lol', 'table': 'test',
+                        'batch_size': 'auto'})
+    foo = blueprint.items['foo']
+    bar = blueprint.items['bar']
+    lol = blueprint.items['lol']
+
+    buffer = Buffer(blueprint, maxlen=20)
+    assert buffer.sizes == {'foo': 2, 'bar': 20, 'lol': 20}
+    assert buffer.tuned == {'lol'}
+    assert Buffer(blueprint, adaptive=True).tuned == {'bar', 'lol'}
+    # the batch sizes are not tuned with a seed
+    blueprint.seed = 42
+    assert Buffer(blueprint, adaptive=True).tuned == set()
+    blueprint.seed = None
+
+    foo.generate(buffer, 5)
+    bar.generate(buffer, 25)
+    assert [
+        (item.name, len(objs))
+        for (item, objs), _ in blueprint.backend.write.call_args_list
+    ] == [('foo', 2), ('foo', 2), ('bar', 20)]
+
+    # the batch size is tuned to write a batch in TARGET_DURATION
+    # (by a factor of 2 at most)
+    times = iter([0, 0.25, 10, 10.4, 20, 25])
+    time = mocker.patch('populous.buffer.time')
+    time.perf_counter.side_effect = lambda: next(times)
+    lol.generate(buffer, 20)
+    assert buffer.sizes['lol'] == 40
+    lol.generate(buffer, 40)
+    assert buffer.sizes['lol'] == 50
+    lol.generate(buffer, 50)
+    assert buffer.sizes['lol'] == 25
+
+    # the values of a batch must fit in MAX_BATCH_MEMORY
+    mocker.patch('populous.buffer.MAX_BATCH_MEMORY', 1500)
+    buffer.tune(lol, 0.1, 100)
+    assert buffer.sizes['lol'] == 15
+
+    logger = mocker.patch('populous.buffer.logger')
+    buffer.report()
+    assert logger.info.call_args == mocker.call(
+        "Item 'lol': batch size tuned to 15"
+    )
+
+
+def test_write_buffer_max_memory(mocker):
+    class DummyBackend(Backend):
+        def write(self, item, objs):
+            return range(len(objs))
+
+    blueprint = Blueprint(
+        backend=mocker.Mock(wraps=DummyBackend(), columnar=False)
+    )
+    blueprint.add_item({'name': 'foo', 'table': 'test',
+                        'fields': {'a': 'x' * 1000}})
+    blueprint.add_item({'name': 'bar', 'table': 'test',
+                        'fields': {'a': 'x'}})
+    foo = blueprint.items['foo']
+    bar = blueprint.items['bar']
+
+    buffer = Buffer(blueprint, max_memory=10000)
+    bar.generate(buffer, 10)
+    assert blueprint.backend.write.called is False
+    assert 0 < buffer.total_memory < 10000
+
+    # the largest buffer is written when the memory is exceeded
+    foo.generate(buffer, 20)
+    sizes = [
+        (item.name, len(objs))
+        for (item, objs), _ in blueprint.backend.write.call_args_list
+    ]
+    assert sizes and all(name == 'foo' for name, _ in sizes)
+    assert sum(size for _, size in sizes) < 20
+    assert len(buffer.buffers['bar']) == 10
+    assert buffer.total_memory <= 10000
+    assert buffer.total_memory == sum(buffer.memory.values())
+
+    buffer.flush()
+    assert buffer.total_memory == 0
+
+
 def test_write_empty_buffer(mocker):
     blueprint = Blueprint(backend=Backend())
     blueprint.add_item({'name': 'foo', 'table': 'test', 'fields': {'a': 42}})
@@ -227,7 +561,7 @@ def test_write_empty_buffer(mocker):
 
 
 def test_flush_buffer(mocker):
-    blueprint = Blueprint(backend=mocker.MagicMock())
+    blueprint = Blueprint(backend=mocker.MagicMock(columnar=False))
     blueprint.add_item({'name': 'foo', 'table': 'test'})
     blueprint.add_item({'name': 'bar', 'table': 'test'})
 
@@ -257,7 +591,9 @@ def test_flush_buffer_with_dependencies(mocker):
         def write(self, item, objs):
             return range(len(objs))
 
-    blueprint = Blueprint(backend=mocker.Mock(wraps=DummyBackend()))
+    blueprint = Blueprint(
+        backend=mocker.Mock(wraps=DummyBackend(), columnar=False)
+    )
     blueprint.add_item({'name': 'foo', 'table': 'test'})
     blueprint.add_item({'name': 'bar', 'table': 'test',
                         'count': {'number': 1, 'by': 'foo'}})
@@ -319,12 +655,17 @@ def test_generate_dependencies():
 
     buffer.write(foo)
     assert len(buffer.buffers['foo']) == 0
-    assert len(buffer.buffers['bar']) == 0
-    assert len(buffer.buffers['lol']) == 0
+    # the objects generated are kept until their batch is full
+    assert len(buffer.buffers['bar']) == 20
+    assert 10 <= len(buffer.buffers['lol']) <= 20
 
     assert len(blueprint.vars['bars']) == 20
     assert 10 <= len(blueprint.vars['lols']) <= 20
 
+    buffer.flush()
+    assert len(buffer.buffers['bar']) == 0
+    assert len(buffer.buffers['lol']) == 0
+
     def ids():
         for x in range(10):
             yield x
@@ -362,13 +703,13 @@ def test_generate_dependencies_ancestors():
     buffer.write(foo3)
     assert len(buffer.buffers['foo2']) == 2
     assert len(buffer.buffers['foo3']) == 0
-    assert len(buffer.buffers['bar']) == 0
+    assert len(buffer.buffers['bar']) == 4
     assert len(blueprint.vars['bars']) == 4
 
     buffer.write(foo2)
     assert len(buffer.buffers['foo2']) == 0
     assert len(buffer.buffers['foo3']) == 0
-    assert len(buffer.buffers['bar']) == 0
+    assert len(buffer.buffers['bar']) == 8
     assert len(blueprint.vars['bars']) == 8
 
 
@@ -410,12 +751,125 @@ def test_generate_dependencies_tree():
 
     buffer.write(foo1)
 
+    # the second level is generated, but not written yet
+    assert len(blueprint.vars['foo2s']) == 4
+    assert len(blueprint.vars['foo3s']) == 0
+
+    buffer.flush()
+
     assert len(blueprint.vars['foo1s']) == 2
     assert len(blueprint.vars['foo2s']) == 4
     assert len(blueprint.vars['foo3s']) == 8
     assert len(blueprint.vars['bars']) == 14
 
 
+def test_generate_dependencies_deep(mocker):
+    class DummyBackend(Backend):
+        def write(self, item, objs):
+            return range(len(objs))
+
+    blueprint = Blueprint(
+        backend=mocker.Mock(wraps=DummyBackend(), columnar=False)
+    )
+    blueprint.add_item({'name': 'foo0', 'table': 'test'})
+    # deeper than what a recursion would allow
+    for x in range(1, 200):
+        blueprint.add_item({'name': f'foo{x}', 'table': 'test',
+                            'count': {'number': 1, 'by': f'foo{x - 1}'},
+                            'fields': {'level': x}})
+
+    buffer = Buffer(blueprint, maxlen=3)
+    blueprint.items['foo0'].generate(buffer, 1)
+    buffer.flush()
+
+    written = {}
+    for (item, objs), _ in blueprint.backend.write.call_args_list:
+        written[item.name] = written.get(item.name, 0) + len(objs)
+    assert written['foo1'] == 1
+    assert written['foo199'] == 1
+    assert not buffer.pending
+
+
+def test_generate_dependencies_coalesce(mocker):
+    class DummyBackend(Backend):
+        def write(self, item, objs):
+            return range(len(objs))
+
+    blueprint = Blueprint(
+        backend=mocker.Mock(wraps=DummyBackend(), columnar=False)
+    )
+    blueprint.add_item({'name': 'foo', 'table': 'test'})
+    blueprint.add_item({'name': 'bar', 'table': 'test',
+                        'count': {'number': 1, 'by': 'foo'},
+                        'store_in': {'bars': '$this'}})
+    blueprint.add_item({'name': 'lol', 'table': 'test',
+                        'count': {'number': 1, 'by': 'foo'},
+                        'fields': {'bar_id': '$(bars[-1].id)'}})
+
+    buffer = Buffer(blueprint, maxlen=10)
+    foo = blueprint.items['foo']
+    assert blueprint.items['lol'].needed_items == [blueprint.items['bar']]
+    for _ in range(5):
+        foo.generate(buffer, 2)
+        buffer.write(foo)
+    buffer.flush()
+
+    # the bars are written before generating the lols using their ids,
+    # and the lols are written in one batch
+    sizes = [
+        (item.name, len(objs))
+        for (item, objs), _ in blueprint.backend.write.call_args_list
+    ]
+    assert sizes == [('foo', 2), ('bar', 2)] * 5 + [('lol', 10)]
+    lols = blueprint.backend.write.call_args_list[-1][0][1]
+    assert [bar_id for bar_id, in lols] == [1] * 10
+
+
+def test_blueprint_dependents():
+    blueprint = Blueprint()
+    blueprint.add_item({'name': 'foo', 'table': 'test'})
+    blueprint.add_item({'name': 'foo2', 'parent': 'foo'})
+    blueprint.add_item({'name': 'bar', 'table': 'test',
+                        'count': {'number': 2, 'by': 'foo'}})
+    assert blueprint.dependents == {
+        'foo': [blueprint.items['bar']],
+        'foo2': [blueprint.items['bar']],
+        'bar': [],
+    }
+
+    blueprint.add_item({'name': 'lol', 'table': 'test',
+                        'count': {'number': 2, 'by': 'foo2'}})
+    assert blueprint.dependents['foo'] == [blueprint.items['bar']]
+    assert blueprint.dependents['foo2'] == [
+        blueprint.items['bar'], blueprint.items['lol']
+    ]
+
+
+def test_count_batch(mocker):
+    blueprint = Blueprint()
+    blueprint.add_var('nb', 3)
+    blueprint.add_item({'name': 'foo', 'table': 'test',
+                        'fields': {'nb': 5}})
+    item = blueprint.items['foo']
+    parents = [item.object_class(id=x, nb=x) for x in range(4)]
+
+    item.add_count(number='$nb', by='foo')
+    assert item.count.batch(parents) == [3, 3, 3, 3]
+
+    item.add_count(min=1, max='$nb', by='foo')
+    counts = item.count.batch(parents)
+    assert len(counts) == 4
+    assert all(1 <= count <= 3 for count in counts)
+
+    # the counts depending on the parent are evaluated for each parent
+    item.add_count(number='$foo.nb', by='foo')
+    counts = item.count.batch(parents)
+    assert 'foo' not in blueprint.vars
+    assert next(counts) == 0
+    assert 'foo' not in blueprint.vars
+    assert list(counts) == [1, 2, 3]
+
+
 def test_generate__count_with_var():
     class DummyBackend(Backend):
         def write(self, item, objs):
@@ -463,7 +917,7 @@ def test_store_values():
     # the values have been generated, but empty ids have been stored
     assert [foo.id for foo in blueprint.vars['foos']] == [None] * 10
 
-    buffer.write(blueprint.items['foo'])
+    buffer.flush()
 
     # the stored ids have now been replaced
     assert [foo.id for foo in blueprint.vars['foos']] == list(range(10))
@@ -477,3 +931,160 @@ def test_store_values():
             (next(ids), 0),
             (next(ids), 1),
         ]
+
+
+def test_store_ids():
+    class DummyBackend(Backend):
+        counters = {}
+
+        def write(self, item, objs):
+            counter = self.counters.setdefault(item.name, count(1))
+            return [next(counter) for _ in objs]
+
+    blueprint = Blueprint(backend=DummyBackend())
+    blueprint.add_item({'name': 'foo', 'table': 'test',
+                        'store_in': {'foos': '$this',
+                                     'foo_ids': '$this.id',
+                                     'foo_names': '$(this.id|string)'}})
+    blueprint.add_item({'name': 'bar', 'table': 'test2',
+                        'count': {'by': 'foo', 'number': 2},
+                        'store_in': {'this.foo.bar_ids': '$this.id'}})
+    foo = blueprint.items['foo']
+    assert foo.deferred_store_in == {'foo_ids', 'foo_names'}
+
+    buffer = Buffer(blueprint, maxlen=15)
+    foo.generate(buffer, 10)
+
+    # the ids are not known yet
+    assert len(blueprint.vars['foo_ids']) == 10
+    assert len(foo.pending) == 10
+
+    buffer.flush()
+
+    # the pending values have been evaluated once the objects written
+    assert blueprint.vars['foo_ids'] == list(range(1, 11))
+    assert blueprint.vars['foo_names'] == [str(x) for x in range(1, 11)]
+    assert foo.pending == {}
+    assert blueprint.items['bar'].pending == {}
+
+    ids = iter(range(1, 21))
+    for obj in blueprint.vars['foos']:
+        assert obj.bar_ids == [next(ids), next(ids)]
+
+
+def test_store_ids_self_reference():
+    class DummyBackend(Backend):
+        counters = count(1)
+        written = []
+
+        def write(self, item, objs):
+            index = item.db_fields.index('other')
+            self.written.extend(row[index] for row in objs)
+            return [next(self.counters) for _ in objs]
+
+    # an item choosing among the ids of its own objects
+    blueprint = Blueprint(backend=DummyBackend())
+    blueprint.add_item({'name': 'foo', 'table': 'test',
+                        'store_in': {'foo_ids': '$this.id'},
+                        'fields': {'other': {'generator': 'Choices',
+                                             'choices': '$foo_ids'}}})
+    blueprint.vars['foo_ids'].append(0)
+
+    buffer = Buffer(blueprint, maxlen=5)
+    blueprint.items['foo'].generate(buffer, 20)
+    buffer.flush()
+
+    # the ids not known yet are read as None
+    written = DummyBackend.written
+    assert len(written) == 20
+    assert all(value is None or type(value) is int for value in written)
+    assert None in written
+    assert blueprint.vars['foo_ids'] == list(range(21))
+
+
+def test_keyed_store():
+    class DummyBackend(Backend):
+        counters = {}
+
+        def write(self, item, objs):
+            counter = self.counters.setdefault(item.name, count(1))
+            return [next(counter) for _ in objs]
+
+    blueprint = Blueprint(backend=DummyBackend())
+    blueprint.add_item({'name': 'world', 'table': 'worlds', 'count': 3,
+                        'store_in': {'worlds': '$this'}})
+    blueprint.add_item({'name': 'city', 'table': 'cities',
+                        'count': {'by': 'world', 'number': 2},
+                        'fields': {'world_id': '$this.world.id'},
+                        'store_in': {
+                            'cities_by_world[$this.world_id]': '$this.id',
+                        }})
+    blueprint.add_item({'name': 'abode', 'table': 'abodes',
+                        'count': {'by': 'world', 'number': 5},
+                        'store_in': {'abodes': '$this'},
+                        'fields': {
+                            'city_id': {
+                                'generator': 'Choices',
+                                'choices': '$(cities_by_world[this.world.id])',
+                            },
+                        }})
+    city = blueprint.items['city']
+    abode = blueprint.items['abode']
+    assert city in abode.needed_items
+
+    buffer = Buffer(blueprint)
+    blueprint.items['world'].generate(buffer, 3)
+    buffer.flush()
+
+    cities = blueprint.vars['cities_by_world']
+    assert sorted(cities) == [1, 2, 3]
+    for world in blueprint.vars['worlds']:
+        assert len(cities[world.id]) == 2
+
+    # the abodes are in a city of their world
+    abodes = blueprint.vars['abodes']
+    assert len(abodes) == 15
+    for obj in abodes:
+        assert obj.city_id in cities[obj.world.id]
+
+
+def test_random_access():
+    class DummyBackend(Backend):
+        def write(self, item, objs):
+            return range(len(objs))
+
+    def generate(rows):
+        blueprint = Blueprint(backend=DummyBackend(), seed=42,
+                              random_access=True)
+        blueprint.add_item({'name': 'foo', 'table': 'test',
+                            'store_in': {'foos': '$this'},
+                            'fields': {
+                                'a': {'generator': 'Integer'},
+                                'b': {'generator': 'Text', 'max_length': 5,
+                                      'nullable': True},
+                                'c': {'generator': 'Email'},
+                                'e': '$(range(1000)|random)',
+                            }})
+        blueprint.add_item({'name': 'bar', 'table': 'test2',
+                            'count': {'by': 'foo', 'min': 0, 'max': 5},
+                            'store_in': {'this.foo.bars': '$this'},
+                            'fields': {'d': {'generator': 'UUID'}}})
+        blueprint.generate(counts={'foo': rows})
+        return [
+            (obj.a, obj.b, obj.c, obj.e, [bar.d for bar in obj.bars])
+            for obj in blueprint.vars['foos']
+        ]
+
+    rows = generate(range(10))
+    assert len(rows) == 10
+    assert len({row[0] for row in rows}) == 10
+    assert len({row[3] for row in rows}) > 1
+    assert any(row[4] for row in rows)
+
+    # any range of rows gives the same values
+    assert generate(range(10)) == rows
+    assert generate(range(5, 10)) == rows[5:]
+    assert generate(range(3, 4)) + generate(range(4, 7)) == rows[3:7]
+
+    with pytest.raises(ValidationError):
+        Blueprint(random_access=True)
@@ -1,5 +1,6 @@
 import socket
 from itertools import islice
+from datetime import date
 from datetime import datetime
 from contextlib import contextmanager
 from string import ascii_letters
@@ -160,13 +161,13 @@ def test_unique_item(blueprint, item):
     item.add_field('bar', 'Value', value=[], shadow=True)
 
     # add some generated items in a var
-    blueprint.vars['bars'] = [item.namedtuple(id=1, bar=[]),
-                              item.namedtuple(id=2, bar=[])]
+    blueprint.vars['bars'] = [item.object_class(id=1, bar=[]),
+                              item.object_class(id=2, bar=[])]
 
     # unique generator, where the values are items, we should use the id
     generator = generators.Choices(item, 'foo', choices='$bars', shadow=True,
                                    unique=True)
-    assert sorted(take(generator, 2)) == sorted(blueprint.vars['bars'])
+    assert sorted(obj.id for obj in take(generator, 2)) == [1, 2]
     assert 1 in generator.seen
     assert 2 in generator.seen
 
@@ -177,6 +178,112 @@ def test_unique_item(blueprint, item):
     assert msg in str(e.value)
 
 
+def test_generate_batch(item):
+
+    class DummyGenerator(generators.Generator):
+        def generate(self):
+            from itertools import count
+            return count()
+
+    generator = DummyGenerator(item, 'foo')
+    assert generator.get_batch(5) == [0, 1, 2, 3, 4]
+    assert generator.get_batch(3) == [5, 6, 7]
+    assert generator.get_batch(0) == []
+
+    generator = DummyGenerator(item, 'foo', nullable=True)
+    sample = generator.get_batch(1000)
+    assert len(sample) == 1000
+    assert 200 < sample.count(None) < 800
+    assert max(filter(None, sample)) == 1000 - sample.count(None) - 1
+
+
+def test_generate_batch_uniquely(item):
+
+    class DummyGenerator(generators.Generator):
+        def generate(self):
+            while True:
+                import random
+                yield random.randint(0, 9)
+
+    generator = DummyGenerator(item, 'foo', unique=True)
+    assert sorted(generator.get_batch(10)) == list(range(10))
+
+    msg = ("Item 'item', field 'foo': Could not generate a new unique "
+           "value in 10000 tries. Aborting.")
+    with pytest.raises(GenerationError) as e:
+        generator.get_batch(1)
+    assert msg in str(e.value)
+
+
+def test_is_batchable(blueprint, item):
+    blueprint.add_item({'name': 'bar', 'table': 'bar',
+                        'store_in': {'bars': '$this'}})
+    blueprint.vars['min'] = 10
+
+    assert generators.Integer(item, 'foo').is_batchable() is True
+    assert generators.Integer(item, 'foo', min='$min').is_batchable() is True
+    assert generators.Value(item, 'foo', value='$this.bar').is_batchable() \
+        is False
+    assert generators.Value(item, 'foo', value='$(bar.id)').is_batchable() \
+        is False
+    assert generators.Choices(item, 'foo', choices='$bars').is_batchable() \
+        is False
+    assert generators.Text(item, 'foo', max_length='$(this.a + 1)') \
+        .is_batchable() is False
+    assert generators.Integer(item, 'foo', nullable='{{ this.a }}') \
+        .is_batchable() is False
+    assert generators.Integer(item, 'foo', unique=True).is_batchable() is True
+    assert generators.Integer(item, 'foo', unique='bar').is_batchable() \
+        is False
+
+
+@pytest.fixture(params=['numpy', 'python'])
+def batch_mode(request, mocker):
+    if request.param == 'numpy':
+        pytest.importorskip('numpy')
+    else:
+        for module in ('base', 'integer', 'boolean', 'choices', 'uuid',
+                       'date'):
+            mocker.patch(f'populous.generators.{module}.numpy', None)
+    return request.param
+
+
+def test_batches(blueprint, item, batch_mode):
+    import uuid
+    from datetime import date
+
+    sample = generators.Integer(item, 'foo', min=10, max=20).get_batch(1000)
+    assert len(sample) == 1000
+    assert all(type(e) is int and 10 <= e <= 20 for e in sample)
+    assert set(sample) == set(range(10, 21))
+
+    generator = generators.Integer(item, 'foo', to_string=True)
+    assert all(e.isdigit() for e in generator.get_batch(10))
+
+    generator = generators.Integer(item, 'foo', min=0, max=2 ** 70)
+    assert all(0 <= e <= 2 ** 70 for e in generator.get_batch(10))
+
+    sample = generators.Boolean(item, 'foo', ratio=0.1).get_batch(1000)
+    assert all(type(e) is bool for e in sample)
+    assert 0 < sample.count(True) < 200
+
+    sample = generators.Choices(item, 'foo', choices='abc').get_batch(100)
+    assert set(sample) == {'a', 'b', 'c'}
+
+    sample = generators.UUID(item, 'foo').get_batch(100)
+    assert all(isinstance(e, uuid.UUID) and e.version == 4 for e in sample)
+    assert len(set(sample)) == 100
+
+    generator = generators.Date(item, 'foo', after=2015, before=2016)
+    sample = generator.get_batch(100)
+    assert all(type(e) is date and e.year == 2015 for e in sample)
+
+    generator = generators.Integer(item, 'foo', nullable=0.5)
+    sample = generator.get_batch(1000)
+    assert 200 < sample.count(None) < 800
+    assert all(type(e) is int for e in sample if e is not None)
+
+
 def test_integer(blueprint, item):
     generator = generators.Integer(item, 'foo')
     sample = take(generator, 10)
@@ -438,6 +545,29 @@ def test_datetime(blueprint, item):
     assert all(e <= datetime(2012, 10, 10) for e in sample)
 
 
+def test_datetime_now():
+    from populous.blueprint import Blueprint
+
+    def generate(**kwargs):
+        blueprint = Blueprint(seed=42, **kwargs)
+        blueprint.add_item({'name': 'item', 'table': 'table_foo'})
+        item = blueprint.items['item']
+        return (
+            take(generators.DateTime(item, 'foo', past=False, future=True),
+                 10) +
+            take(generators.Date(item, 'foo'), 10)
+        )
+
+    # the dates are drawn from the present given to the blueprint, to get
+    # the same dates on each run
+    now = datetime(2020, 1, 1)
+    sample = generate(now=now)
+    assert all(e >= now for e in sample[:10])
+    assert all(e <= now.date() for e in sample[10:])
+    assert generate(now=now) == sample
+    assert generate() != sample
+
+
 def test_date(blueprint, item):
     from datetime import date
 
@@ -623,3 +753,114 @@ def test_yaml(blueprint, item):
     blueprint.backend = DummyBackend()
     generator = generators.Yaml(item, 'foo', value="{'foo': 42}", to_json=True)
     assert take(generator, 2) == ['bar', 'bar']
+
+
+def test_seed(batch_mode):
+    from populous.blueprint import Blueprint
+
+    def generate(seed, name='foo'):
+        blueprint = Blueprint(seed=seed)
+        blueprint.add_item({'name': 'item', 'table': 'table_foo'})
+        item = blueprint.items['item']
+        fields = (
+            generators.Integer(item, name, nullable=True),
+            generators.Text(item, name, max_length=20),
+            generators.UUID(item, name),
+            generators.Choices(item, name, choices='abcdef'),
+            generators.Email(item, name),
+            generators.Name(item, name),
+        )
+        return [(take(field, 10), field.get_batch(10)) for field in fields]
+
+    # the same seed gives the same values
+    assert generate(42) == generate(42)
+    assert generate('foo') == generate('foo')
+    assert generate(42) != generate(43)
+    # each field has its own values
+    assert generate(42) != generate(42, name='bar')
+
+    # without a seed, the generators are shared
+    blueprint = Blueprint()
+    blueprint.add_item({'name': 'item', 'table': 'table_foo'})
+    generator = generators.Integer(blueprint.items['item'], 'foo')
+    assert generator.fake is generators.base.fake
+    assert generator.np_random is generators.base.np_random
+
+
+def test_seed_batch_size(batch_mode):
+    from populous.blueprint import Blueprint
+
+    def generate(sizes):
+        blueprint = Blueprint(seed=42)
+        blueprint.add_item({'name': 'item', 'table': 'table_foo'})
+        item = blueprint.items['item']
+        fields = (
+            generators.Integer(item, 'foo', max=10, nullable=0.3),
+            generators.Boolean(item, 'bar', nullable=0.3),
+            generators.Text(item, 'baz', max_length=20, nullable=0.3),
+            generators.UUID(item, 'lol', unique=True),
+        )
+        return [
+            [value for size in sizes for value in field.get_batch(size)]
+            for field in fields
+        ]
+
+    # the values don't depend on the size of the batches
+    values = generate([10] * 7)
+    assert any(None in column for column in values)
+    assert generate([7] * 10) == values
+    assert generate([70]) == values
+
+
+def test_unique_partition(blueprint, item, batch_mode):
+    choices = [f'value{i}' for i in range(20)]
+    integers = []
+    strings = []
+    dates = []
+    for index in range(3):
+        blueprint.partition = (index, 3)
+        generator = generators.Integer(item, 'foo', max=29, unique=True)
+        integers.append(set(generator.get_batch(10)))
+
+        generator = generators.Date(item, 'foo', after=date(2020, 1, 1),
+                                    before=date(2020, 1, 30), unique=True)
+        dates.append(set(generator.get_batch(10)))
+
+        generator = generators.Choices(item, 'foo', choices=choices,
+                                       unique=True)
+        values = set()
+        with pytest.raises(GenerationError):
+            while True:
+                values.add(next(generator))
+        strings.append(values)
+
+    # each process generates its own values
+    assert set.union(*integers) == set(range(30))
+    assert len(set.union(*dates)) == 30
+    assert set.union(*strings) == set(choices)
+    assert sum(map(len, strings)) == len(choices)
+
+    # the texts start with the index of the partition
+    blueprint.partition = (75, 100)
+    generator = generators.Text(item, 'foo', max_length=4, chars='abc',
+                                unique=True)
+    assert generator.get_prefix() == 'abcca'
+    with pytest.raises(GenerationError):
+        generator.get_batch(1)
+    generator = generators.Text(item, 'foo', chars='0123456789',
+                                unique=True)
+    assert all(value.startswith('57') for value in generator.get_batch(100))
+    generator = generators.Email(item, 'foo', unique=True)
+    assert all('.75@' in value for value in generator.get_batch(100))
+    assert generators.UUID(item, 'foo', unique=True).get_partition() is None
+
+    # the values unique with other fields, and the values taken from the
+    # stores, only depend on the objects of each process
+    blueprint.add_item({'name': 'bar', 'table': 'test',
+                        'store_in': {'bars': '$this.id'}})
+    assert generators.Integer(item, 'foo', unique=True).partitioned is True
+    generator = generators.Integer(item, 'foo', max=29, unique='bar')
+    assert generator.partitioned is False
+    assert generator.get_partition() is None
+    assert generators.Choices(item, 'foo', choices='$bars',
+                              unique=True).partitioned is False
@@ -0,0 +1,167 @@
+import contextlib
+import multiprocessing
+
+import pytest
+
+from populous.backends.base import Backend
+from populous.blueprint import Blueprint
+from populous.buffer import Buffer
+from populous.cli import _generate
+from populous.compat import shared_memory
+from populous.exceptions import GenerationError
+from populous.pipeline import Pipeline
+from populous.pipeline import Ring
+
+pytestmark = pytest.mark.skipif(shared_memory is None,
+                                reason="shared memory is not available")
+
+
+class FileBackend(Backend):
+    # a backend loading the rows in a file once committed, failing to load
+    # the batches of all the tables or of the one given by 'fail'
+    loadable = True
+
+    def __init__(self, path=None, fail=False):
+        super().__init__()
+        self.path = path
+        self.fail = fail
+        self.loaded = []
+
+    @contextlib.contextmanager
+    def transaction(self):
+        self.loaded = []
+        yield
+        with open(self.path, 'ab') as f:
+            f.write(b''.join(self.loaded))
+
+    def write(self, item, objs):
+        return range(len(objs))
+
+    def encode_rows(self, item, rows):
+        return ''.join(
+            ','.join(map(str, row)) + '\n' for row in rows
+        ).encode()
+
+    def load(self, table, fields, data):
+        if self.fail is True or self.fail == table:
+            raise ValueError(f"Cannot load '{table}'")
+        self.loaded.append(data)
+
+
+def test_ring():
+    ring = Ring(64, multiprocessing.get_context('spawn'))
+    try:
+        # the messages wrap at the end of the ring
+        for i in range(20):
+            ring.put(b'foo%d' % i)
+            ring.put(b'bar' * i if i < 10 else b'')
+            assert ring.get() == b'foo%d' % i
+            assert ring.get() == (b'bar' * i if i < 10 else b'')
+
+        with pytest.raises(GenerationError):
+            ring.put(b'x' * 64)
+    finally:
+        ring.unlink()
+
+
+def test_buffer_pipeline(mocker):
+    blueprint = Blueprint(backend=FileBackend())
+    blueprint.add_item({'name': 'foo', 'table': 'test',
+                        'fields': {'a': 42}})
+    blueprint.add_item({'name': 'bar', 'table': 'test2', 'count': 1,
+                        'store_in': {'bars': '$this'}})
+    blueprint.add_item({'name': 'baz', 'table': 'test3',
+                        'count': {'by': 'bar', 'number': 1},
+                        'fields': {'bar_id': '$this.bar.id'}})
+    blueprint.add_item({'name': 'lol', 'table': 'test4',
+                        'fields': {'bar': {'generator': 'Choices',
+                                           'choices': '$bars'}}})
+    foo = blueprint.items['foo']
+    bar = blueprint.items['bar']
+    assert foo.offloadable is True
+    # the ids of the objects are used
+    assert bar.offloadable is False
+    # the objects reference the objects of the generation
+    assert blueprint.items['baz'].offloadable is False
+    assert blueprint.items['lol'].offloadable is False
+
+    pipeline = mocker.Mock()
+    buffer = Buffer(blueprint, pipeline=pipeline)
+    foo.generate(buffer, 3)
+    bar.generate(buffer, 2)
+    buffer.flush()
+
+    # only the objects which can be written apart are sent to the loaders
+    assert pipeline.load.call_args_list == [
+        mocker.call(foo, b'42\n42\n42\n')
+    ]
+    assert [obj.id for obj in blueprint.vars['bars']] == [0, 1]
+
+
+def test_pipeline(tmp_path):
+    path = tmp_path / 'rows'
+    blueprint = Blueprint(backend=FileBackend())
+    blueprint.add_item({'name': 'foo', 'table': 'test', 'count': 100,
+                        'fields': {'a': '$(this.id)'}})
+
+    pipeline = Pipeline(FileBackend, {'path': str(path)}, 2, size=1024)
+    blueprint.generate(batch_size=10, pipeline=pipeline)
+    pipeline.close()
+
+    assert path.read_text() == 'None\n' * 100
+
+
+def test_pipeline_error(tmp_path):
+    blueprint = Blueprint(backend=FileBackend())
+    blueprint.add_item({'name': 'foo', 'table': 'test', 'count': 100,
+                        'fields': {'a': 'x' * 100}})
+
+    pipeline = Pipeline(FileBackend, {'fail': True}, 1, size=1024)
+    with pytest.raises(GenerationError) as e:
+        blueprint.generate(batch_size=5, pipeline=pipeline)
+        pipeline.close()
+    assert "Loader 0: Cannot load 'test'" in str(e.value)
+    pipeline.close(commit=False)
+
+
+def test_pipeline_rollback(tmp_path):
+    path = tmp_path / 'rows'
+    blueprint = Blueprint(backend=FileBackend())
+    blueprint.add_item({'name': 'foo', 'table': 'test', 'count': 100})
+    blueprint.add_item({'name': 'bar', 'table': 'test2', 'count': 1})
+
+    # the loader loading the batch of 'bar' fails: the other one does not
+    # commit the batches of 'foo'
+    pipeline = Pipeline(FileBackend, {'path': str(path), 'fail': 'test2'},
+                        2, size=1024)
+    with pytest.raises(GenerationError) as e:
+        try:
+            blueprint.generate(batch_size=10, pipeline=pipeline)
+            pipeline.close()
+        finally:
+            pipeline.close(commit=False)
+    assert "Cannot load 'test2'" in str(e.value)
+    assert not path.exists()
+
+
+def test_generate_pipeline_error(tmp_path):
+    blueprint = tmp_path / 'blueprint.yml'
+    blueprint.write_text("""
+items:
+  - name: foo
+    table: test
+    count: 10
+  - name: bar
+    table: test2
+    count: 1
+    fields:
+      a:
+        generator: Choices
+        choices: $unknown
+""")
+
+    # the error of the generation is kept when the loaders fail too
+    with pytest.raises(GenerationError) as e:
+        _generate(FileBackend, {'fail': True}, [str(blueprint)],
+                  {'batch_size': 5}, loaders=1)
+    assert "'unknown' is undefined" in str(e.value)
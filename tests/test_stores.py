@@ -0,0 +1,188 @@
+import os
+import random
+from uuid import uuid4
+
+import pytest
+
+from populous.compat import shared_memory
+from populous.exceptions import GenerationError
+from populous.stores import PackedStrings
+from populous.stores import Pending
+from populous.stores import SharedStore
+from populous.stores import Store
+from populous.stores import unlink_shared_store
+
+
+@pytest.fixture
+def small_store(mocker):
+    mocker.patch('populous.stores.KEEP_SIZE', 10)
+    mocker.patch('populous.stores.SPILL_SIZE', 64)
+    return Store()
+
+
+def test_store_pack_ints(small_store):
+    store = small_store
+    store.extend(range(100))
+
+    assert len(store) == 100
+    assert store.packed is not None
+    assert len(store.values) < 20
+    assert store == list(range(100))
+    assert list(store) == list(range(100))
+    assert store[0] == 0
+    assert store[42] == 42
+    assert store[-1] == 99
+    assert store[-3:] == [97, 98, 99]
+    assert random.choice(store) in range(100)
+
+    with pytest.raises(IndexError):
+        store[100]
+
+
+def test_store_spill(small_store):
+    store = small_store
+    store.extend(range(100))
+
+    # 90 integers of 8 bytes are more than SPILL_SIZE
+    assert store.packed.file is not None
+    store.extend(range(100, 1000))
+    assert store == list(range(1000))
+
+    store[5] = -5
+    assert store[5] == -5
+
+
+def test_store_pack_uuids_and_strings(small_store):
+    uuids = [uuid4() for _ in range(50)]
+    small_store.extend(uuids)
+    assert small_store.packed is not None
+    assert small_store == uuids
+
+    strings = Store()
+    strings.extend(['foo', 'bar', 'baz'] * 20)
+    assert strings.packed is not None
+    assert strings.packed.codec.strings == ['foo', 'bar', 'baz']
+    assert strings == ['foo', 'bar', 'baz'] * 20
+
+    # the distinct strings are not interned
+    unique = Store()
+    unique.extend(f'foo{i}é' for i in range(50))
+    assert isinstance(unique.packed, PackedStrings)
+    assert unique == [f'foo{i}é' for i in range(50)]
+    unique[3] = 'bar'
+    assert unique[3] == 'bar'
+    assert unique[4] == 'foo4é'
+
+    # nor the strings which stop repeating
+    strings.extend(f'foo{i}' for i in range(100))
+    assert isinstance(strings.packed, PackedStrings)
+    assert strings == ['foo', 'bar', 'baz'] * 20 + [
+        f'foo{i}' for i in range(100)
+    ]
+
+
+def test_store_replace_last_values(small_store):
+    store = small_store
+    store.extend(range(50))
+    store[-5:] = range(5)
+
+    assert store == list(range(45)) + list(range(5))
+
+    with pytest.raises(ValueError):
+        store[-5:] = [1, 2]
+
+
+def test_store_unpack(small_store):
+    store = small_store
+    store.extend(range(30))
+    assert store.packed is not None
+
+    # a value which cannot be packed with the others
+    store.extend([None] * 30)
+    assert store.packed is None
+    assert store.packable is False
+    assert store == list(range(30)) + [None] * 30
+
+    mixed = Store()
+    mixed.extend([1, 'foo'] * 20)
+    assert mixed.packed is None
+    assert mixed == [1, 'foo'] * 20
+
+    replaced = Store()
+    replaced.extend(range(30))
+    replaced[0] = 'foo'
+    assert replaced.packed is None
+    assert replaced == ['foo'] + list(range(1, 30))
+
+
+def test_store_pending(small_store):
+    store = small_store
+    store.extend(range(15))
+    pending = Pending(store, len(store), None)
+    store.append(pending)
+    store.extend(range(16, 50))
+
+    # the values after the pending value are not packed, and the pending
+    # value reads as None
+    assert len(store.packed) == 15
+    assert store.packable is True
+    assert store[15] is None
+    assert list(store)[15] is None
+
+    store[15] = 15
+    store.append(50)
+    assert len(store.packed) > 15
+    assert store == list(range(51))
+
+
+@pytest.fixture
+def shared_prefix(mocker):
+    if shared_memory is None:
+        pytest.skip("shared memory is not available")
+    mocker.patch('populous.stores.SHARED_CHUNK_SIZE', 4)
+    prefix = f'populous_test_{os.getpid()}'
+    yield prefix
+    unlink_shared_store(prefix, 2)
+
+
+def test_shared_store(shared_prefix):
+    # two workers sharing a store
+    store0 = SharedStore(shared_prefix, 0, 2)
+    store1 = SharedStore(shared_prefix, 1, 2)
+
+    store0.extend(range(10))
+    assert len(store0) == 10
+    assert list(store0) == list(range(10))
+
+    # the values are shared once published
+    assert len(store1) == 0
+    store0.publish()
+    assert len(store1) == 10
+    assert list(store1) == list(range(10))
+
+    # the pending values are only written once set
+    pending = Pending(store1, None, None)
+    store1.append(pending)
+    store1.append(11)
+    assert pending.index == 0
+    assert len(store1) == 10
+    store1.publish()
+    assert len(store0) == 10
+
+    store1[pending.index] = 10
+    assert len(store1) == 12
+    assert len(store0) == 10
+    store1.publish()
+    assert len(store0) == 12
+    assert list(store0) == list(range(12))
+    assert store0[-1] == 11
+    assert random.choice(store0) in range(12)
+
+    with pytest.raises(IndexError):
+        store0[12]
+
+    with pytest.raises(GenerationError):
+        store0.append('foo')
+
+    store0.close()
+    store1.close()
@@ -163,6 +163,45 @@ def test_jinja_value_expression():
     assert msg in str(e.value)
 
 
+def test_jinja_value_expression_python(mocker):
+    from populous.vars import Context
+    from populous.vars import JinjaValueExpression
+
+    class Val:
+        None
+
+    this = Val()
+    this.count = 21
+    this.name = 'foo'
+    context = Context({'foo': {'bar': 2}, 'l': [1, 2, 3]}, this=this)
+
+    expressions = {
+        'this.count * 2': 42,
+        'this.count // 2 + l[1] - 1 if this.count > 20 else 0': 11,
+        '(this.name|upper) ~ "-" ~ this.count': 'FOO-21',
+        'this.name|center(5) ~ this.count|string|length': ' foo 2',
+        'foo.bar ** 2 + foo["bar"]': 6,
+        'not this.count in l and -1 < 0 <= l|count': True,
+        '(1, 2) == (l[0], l[1],) and [1] != [2] or none': True,
+        'this.missing|default("x", true)': 'x',
+    }
+    for source, expected in expressions.items():
+        v = JinjaValueExpression(source)
+        assert v.function is not None
+        template = mocker.patch.object(v, 'template', wraps=v.template)
+        assert v.evaluate_in(context) == expected
+        assert template.new_context.called is ('missing' in source)
+
+    # the expressions not supported are evaluated by jinja
+    for source in ('range(2)', 'l|random', 'l|first', 'l[1:]', 'l is none',
+                   '1 if true'):
+        assert JinjaValueExpression(source).function is None
+
+    # the same expressions are compiled once
+    v = JinjaValueExpression('this.count * 2')
+    assert v.function is JinjaValueExpression('this.count * 2').function
+
+
 def test_template_expression():
     from populous.vars import TemplateExpression
 
@@ -217,6 +256,41 @@ def test_template_expression():
     assert msg in str(e.value)
 
 
+def test_template_expression_python(mocker):
+    from populous.vars import Context
+    from populous.vars import TemplateExpression
+
+    class Val:
+        None
+
+    this = Val()
+    this.first = 'John'
+    this.last = 'Doe'
+    context = Context({'domain': 'corp.test'}, this=this)
+
+    t = TemplateExpression('{{ this.first|lower }}.{{ this.last|lower }}'
+                           '@{{ domain }} {# email #}')
+    assert t.function is not None
+    template = mocker.patch.object(t, 'template')
+    assert t.evaluate_in(context) == 'john.doe@corp.test '
+    assert template.new_context.called is False
+
+    assert TemplateExpression('').evaluate_in(context) == ''
+    assert TemplateExpression('{{ 42 }}').evaluate_in(context) == '42'
+
+    # the errors are raised by jinja
+    t = TemplateExpression('{{ this.missing }}')
+    assert t.function is not None
+    with pytest.raises(GenerationError) as e:
+        t.evaluate_in(context)
+    assert "has no attribute 'missing'" in str(e.value)
+
+    # the templates with logic are rendered by jinja
+    t = TemplateExpression('{% if domain %}{{ domain }}{% endif %}')
+    assert t.function is None
+    assert t.evaluate_in(context) == 'corp.test'
+
+
 def test_jinja_random():
     from populous.vars import JinjaValueExpression
     from populous.vars import TemplateExpression
@@ -233,3 +307,65 @@ def test_jinja_random():
 
     t = TemplateExpression('{{ [21, 42]|random }}')
     assert {t.evaluate() for _ in range(100)} == {"21", "42"}
+
+
+def test_deterministic():
+    from populous.vars import JinjaValueExpression
+    from populous.vars import TemplateExpression
+    from populous.vars import ValueExpression
+
+    assert ValueExpression('foo.bar').deterministic is True
+    assert JinjaValueExpression('foo.bar|upper + "x"').deterministic is True
+    assert JinjaValueExpression('foo|random').deterministic is False
+    assert JinjaValueExpression('fake.word()').deterministic is False
+    assert TemplateExpression('{{ foo }}-{{ bar }}').deterministic is True
+    assert TemplateExpression('{{ foo|random }}').deterministic is False
+
+
+def test_attributes():
+    from populous.vars import JinjaValueExpression
+    from populous.vars import TemplateExpression
+    from populous.vars import ValueExpression
+
+    assert ValueExpression('foo').attributes == frozenset()
+    assert ValueExpression('foo.bar.baz').attributes == {'bar', 'baz'}
+    assert JinjaValueExpression(
+        '(foo|random).bar + foo|map(attribute="baz")|sum'
+    ).attributes == {'bar', 'baz'}
+    assert TemplateExpression('{{ this.foo.bar }}').attributes == {
+        'foo', 'bar'
+    }
+
+
+def test_context():
+    from populous.vars import Context
+    from populous.vars import JinjaValueExpression
+    from populous.vars import TemplateExpression
+    from populous.vars import ValueExpression
+
+    class Val:
+        None
+
+    vars_ = {'foo': 41, 'this': 'ignored'}
+    context = Context(vars_)
+
+    this = Val()
+    this.bar = 1
+    context.this = this
+
+    assert ValueExpression('this.bar').evaluate_in(context) == 1
+    assert JinjaValueExpression('foo + this.bar').evaluate_in(context) == 42
+    t = TemplateExpression('{% for x in range(2) %}{{ this.bar }}{% endfor %}')
+    assert t.evaluate_in(context) == '11'
+
+    # the vars are shared with the context, not copied
+    vars_['foo'] = 1
+    assert JinjaValueExpression('foo + this.bar').evaluate_in(context) == 2
+
+    # without an object, 'this' is looked up in the vars
+    context.this = None
+    assert ValueExpression('this').evaluate_in(context) == 'ignored'
+
+    with pytest.raises(GenerationError) as e:
+        ValueExpression('bar').evaluate_in(context)
+    assert "Error generating value '$bar': 'bar' is undefined" in str(e.value)
@@ -0,0 +1,147 @@
+import itertools
+import json
+import os
+
+import pytest
+
+from populous.backends.base import Backend
+from populous.cli import _generate
+from populous.exceptions import GenerationError
+from populous.workers import ATOMIC
+from populous.workers import Rollback
+from populous.workers import run_workers
+from populous.workers import split_counts
+
+
+def test_split_counts():
+    assert split_counts({'foo': 5, 'bar': 1}, 2) == [
+        {'foo': range(0, 3), 'bar': range(0, 1)},
+        {'foo': range(3, 5), 'bar': range(1, 1)},
+    ]
+    shares = split_counts({'foo': 1000}, 7)
+    assert [row for share in shares for row in share['foo']] == list(
+        range(1000)
+    )
+    assert max(len(share['foo']) for share in shares) - min(
+        len(share['foo']) for share in shares
+    ) <= 1
+
+
+def _target(path, fail=(), counts=None, ready=None, worker=None,
+            workers=None):
+    # a target writing the counts of the worker in a file once committed
+    count = len(counts['foo'])
+    if count in fail:
+        raise ValueError(f"Cannot generate {count} foos")
+    if not ready():
+        raise Rollback()
+    with open(path, 'a') as f:
+        f.write(json.dumps({'foo': count}) + '\n')
+
+
+def _read(path):
+    if not path.exists():
+        return []
+    return sorted(
+        json.loads(line)['foo'] for line in path.read_text().splitlines()
+    )
+
+
+def test_run_workers(tmp_path):
+    path = tmp_path / 'counts'
+    run_workers(_target, (str(path),), {'foo': 10}, 3)
+    assert _read(path) == [3, 3, 4]
+
+
+def test_run_workers_errors(tmp_path):
+    path = tmp_path / 'counts'
+    with pytest.raises(GenerationError) as e:
+        run_workers(_target, (str(path), (3,)), {'foo': 7}, 2)
+    assert str(e.value) == "Worker 1: Cannot generate 3 foos"
+
+    # the other worker committed
+    assert _read(path) == [4]
+
+
+def test_run_workers_atomic(tmp_path):
+    path = tmp_path / 'counts'
+    run_workers(_target, (str(path),), {'foo': 7}, 2, commit=ATOMIC)
+    assert _read(path) == [3, 4]
+
+    # no worker commits when one of them fails
+    path = tmp_path / 'failed'
+    with pytest.raises(GenerationError):
+        run_workers(_target, (str(path), (3,)), {'foo': 7}, 2,
+                    commit=ATOMIC)
+    assert _read(path) == []
+
+
+class FileBackend(Backend):
+    # a backend writing the rows of each worker in a file
+
+    def __init__(self, path=None):
+        super().__init__()
+        self.path = path
+        self.ids = itertools.count(os.getpid() * 1000000)
+
+    def select(self, table, fields):
+        return []
+
+    def write(self, item, objs):
+        with open(self.path, 'a') as f:
+            for obj in objs:
+                f.write(json.dumps([item.table, obj]) + '\n')
+        return [next(self.ids) for _ in objs]
+
+
+BLUEPRINT = """
+items:
+  - name: hobby
+    table: hobby
+    count: 8
+    store_in:
+      hobbies_ids: $this.id
+    fields:
+      name:
+        generator: Integer
+        unique: true
+  - name: citizen
+    table: citizen
+    count: 20
+  - name: hobby_citizen
+    table: hobby_citizen
+    count:
+      number: 4
+      by: citizen
+    fields:
+      citizen_id: $this.citizen.id
+      hobby_id:
+        generator: Choices
+        choices: $hobbies_ids
+        unique: citizen_id
+"""
+
+
+def test_run_workers_unique_with(tmp_path):
+    # the values unique with other fields, and the values taken from a
+    # store, are not shared between the workers: each worker can use all
+    # the hobbies of its store for each of its citizens
+    path = tmp_path / 'rows'
+    blueprint = tmp_path / 'blueprint.yml'
+    blueprint.write_text(BLUEPRINT)
+    run_workers(
+        _generate,
+        (FileBackend, {'path': str(path)}, [str(blueprint)],
+         {'batch_size': 5}),
+        {'hobby': 8, 'citizen': 20}, 2
+    )
+
+    rows = {}
+    for line in path.read_text().splitlines():
+        table, row = json.loads(line)
+        rows.setdefault(table, []).append(tuple(row))
+    assert len(rows['citizen']) == 20
+    assert len(rows['hobby_citizen']) == 80
+    assert len(set(rows['hobby_citizen'])) == 80
+    names = [row[0] for row in rows['hobby']]
+    assert len(set(names)) == 8